@@ -29,7 +29,7 @@
 This package contains the protocols for
 manipulation of atomic struct objects
 """
-import os, subprocess
+import os
 import pwem
 
 _logo = 'lephar_logo.jpg'
@@ -80,14 +80,27 @@ class Plugin(pwem.Plugin):
                      default=True)
 
   @classmethod
-  def runLePhar(cls, protocol, program, args, cwd=None, runJob=True, linuxSuf=True):
-      """ Run LePhar command from a given protocol. """
-      fullProgram = cls.getProgramHome(LEPHAR_DIC, path='bin/{}'.format(cls.getProgramBin(program, linuxSuf)))
+  def runLePhar(cls, protocol, program, args, cwd=None, runJob=True, linuxSuf=True, cpus=None):
+      """ Run LePhar command from a given protocol. If cpus is given, the command is pinned to that set of CPUs
+      (see lephar.utils.getWorkerCpuSets) """
+      from .utils import runCommands, pinThreadAffinity
+      fullProgram = cls.getLePharProgram(program, linuxSuf)
       if runJob:
-          protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
+          # The job process inherits the affinity of the thread launching it
+          with pinThreadAffinity(cpus):
+              protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
       else:
-          fullProgram += args
-          subprocess.call(fullProgram, shell=True, cwd=cwd)
+          runCommands([([fullProgram] + args.split(), cwd)], env=cls.getEnviron(), cpuSets=[cpus] if cpus else None)
+
+  @classmethod
+  def runLePharJobs(cls, program, argsList, cwds, maxJobs=1, linuxSuf=True, timeout=None, check=True):
+      """ Run several LePhar commands concurrently, at most maxJobs at the same time and without shell.
+      argsList contains the list of arguments of each command and cwds their working directories.
+      Returns the list of lephar.utils.JobResult of the commands """
+      from .utils import runCommands
+      fullProgram = cls.getLePharProgram(program, linuxSuf)
+      jobs = [([fullProgram] + list(args), cwd) for args, cwd in zip(argsList, cwds)]
+      return runCommands(jobs, maxJobs, env=cls.getEnviron(), timeout=timeout, check=check)
 
   @classmethod
   def runRDKit2Script(cls, protocol, scriptName, args, cwd=None):
@@ -96,6 +109,16 @@ class Plugin(pwem.Plugin):
     fullProgram = '%s %s && %s %s' % (cls.getCondaActivationCmd(), cls.getRDKit2EnvActivation(), 'python', scriptPath)
     protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
 
+  @classmethod
+  def runRDKit2Jobs(cls, scriptFile, argsList, cwds, maxJobs=1):
+    """ Run several python scripts in the rdkit2 environment concurrently, at most maxJobs at the same time.
+    Returns the list of lephar.utils.JobResult of the commands """
+    from .utils import runCommands
+    activation = '%s %s' % (cls.getCondaActivationCmd(), cls.getRDKit2EnvActivation())
+    jobs = [(['bash', '-c', '%s && python %s %s' % (activation, scriptFile, ' '.join(args))], cwd)
+            for args, cwd in zip(argsList, cwds)]
+    return runCommands(jobs, maxJobs, env=cls.getEnviron())
+
   @classmethod
   def getEnviron(cls):
     pass
@@ -123,6 +146,10 @@ class Plugin(pwem.Plugin):
         programDic = LEPHAR_DIC
     return os.path.join(cls.getVar(programDic['home']), path)
   
+  @classmethod
+  def getLePharProgram(cls, program, linuxSuf=True):
+      return cls.getProgramHome(LEPHAR_DIC, path='bin/{}'.format(cls.getProgramBin(program, linuxSuf)))
+
   @classmethod
   def getProgramBin(cls, program, linuxSuf=True):
       if linuxSuf:
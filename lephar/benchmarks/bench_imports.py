@@ -0,0 +1,86 @@
+# **************************************************************************
+# *
+# * Authors:    Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Import time benchmark of the lephar modules loaded by Scipion on plugin discovery and by the protocol
+subprocesses. Each module is imported in a fresh interpreter with -X importtime, reporting its cumulative import
+time (median of the repetitions), the slowest modules it pulls in and which of the heavy modules (HEAVY_MODULES)
+it loads.
+    python -m lephar.benchmarks.bench_imports --repeats 5
+"""
+
+import argparse, statistics, subprocess, sys
+
+MODULES = ['lephar', 'lephar.protocols', 'lephar.wizards', 'lephar.viewers', 'lephar.utils']
+HEAVY_MODULES = ['numpy', 'pwchem.utils', 'pwchem.objects', 'pwchem.viewers', 'pwem.convert', 'lephar.scoring']
+
+
+def parseImportTimes(stderr):
+    '''Returns a dictionary {module: (self us, cumulative us)} from the -X importtime output'''
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            selfTime, cumTime, name = [field.strip() for field in line[len('import time:'):].split('|')]
+            if selfTime.isdigit():
+                times[name] = (int(selfTime), int(cumTime))
+    return times
+
+def measureImport(module):
+    '''Imports the module in a new interpreter and returns its import times, or None and the error if it failed'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return None, proc.stderr.strip().splitlines()[-1]
+    return parseImportTimes(proc.stderr), None
+
+def benchmarkModule(module, repeats, nTop):
+    cumTimes = []
+    for _ in range(repeats):
+        times, error = measureImport(module)
+        if times is None:
+            print('{:<18s} import failed: {}'.format(module, error))
+            return
+        cumTimes.append(times[module][1])
+
+    heavy = [name for name in HEAVY_MODULES if name in times]
+    print('{:<18s} {:>10.1f} ms   heavy modules loaded: {}'.format(module, statistics.median(cumTimes) / 1000,
+                                                                   ', '.join(heavy) if heavy else 'none'))
+    slowest = sorted([(cum, name) for name, (_, cum) in times.items() if '.' not in name and name != module],
+                     reverse=True)[:nTop]
+    for cum, name in slowest:
+        print('    {:<30s} {:>8.1f} ms'.format(name, cum / 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import time benchmark of the lephar modules')
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='Modules to import')
+    parser.add_argument('--repeats', type=int, default=5, help='Fresh interpreter imports per module')
+    parser.add_argument('--top', type=int, default=5, help='Slowest top level modules shown per module')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        benchmarkModule(module, args.repeats, args.top)
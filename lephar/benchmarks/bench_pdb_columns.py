@@ -0,0 +1,118 @@
+# **************************************************************************
+# *
+# * Authors:    Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Micro-benchmark of the PDB columns completion applied to lepro receptors and LeDock poses. It compares the
+shared lephar.utils.addPDBColumns against the previous per-line split implementation of ProtChemLePro and
+ProtChemLeDock, checking both produce the same files.
+    python -m lephar.benchmarks.bench_pdb_columns --atoms 500000 --poses 2000 --poseAtoms 40
+"""
+
+import os, argparse, filecmp, statistics, tempfile, time
+
+from lephar.utils import addPDBColumns, addPDBColumnsToStr
+from lephar.benchmarks.synthetic import writeSyntheticPDB, writeSyntheticPoses
+
+
+def removeNumberFromStr(s):
+    return ''.join([c for c in s if not c.isdigit()])
+
+def legacyAddPDBColumns(pdbFile, outFile, rightAlign=True):
+    '''Previous implementation of ProtChemLeDock.correctMolFile (rightAlign) and ProtChemLePro.addPDBColumns'''
+    with open(pdbFile) as fIn:
+        with open(outFile, 'w') as f:
+            for line in fIn:
+                if line.startswith('ATOM'):
+                    atomSym = removeNumberFromStr(line.split()[2])
+                    pad = 12 - len(atomSym) if rightAlign else 11
+                    line = line.strip() + '  1.00  0.00{}{}\n'.format(' ' * pad, atomSym)
+                f.write(line)
+    return outFile
+
+def countLines(files):
+    nLines = 0
+    for file in files:
+        with open(file) as f:
+            nLines += sum(1 for _ in f)
+    return nLines
+
+def timeFiles(func, inFiles, outSuffix, rightAlign):
+    start = time.perf_counter()
+    outFiles = [func(inFile, inFile + outSuffix, rightAlign) for inFile in inFiles]
+    return time.perf_counter() - start, outFiles
+
+def timeInMemory(inFiles, rightAlign):
+    contents = []
+    for inFile in inFiles:
+        with open(inFile) as f:
+            contents.append(f.read())
+    start = time.perf_counter()
+    for content in contents:
+        addPDBColumnsToStr(content, rightAlign)
+    return time.perf_counter() - start
+
+def runBenchmark(name, inFiles, rightAlign, repeats):
+    nLines = countLines(inFiles)
+    # Warm up the page cache of the input files, so no implementation pays for the first read
+    timeFiles(legacyAddPDBColumns, inFiles, '.legacy', rightAlign)
+    results = {'legacy': [], 'utils': [], 'in memory': []}
+    for iRep in range(repeats):
+        # The order of the file implementations alternates, so none always runs with the other's outputs cached
+        for impl in (['legacy', 'utils'] if iRep % 2 == 0 else ['utils', 'legacy']):
+            if impl == 'legacy':
+                tLegacy, legacyFiles = timeFiles(legacyAddPDBColumns, inFiles, '.legacy', rightAlign)
+                results['legacy'].append(tLegacy)
+            else:
+                tUtils, utilsFiles = timeFiles(addPDBColumns, inFiles, '.utils', rightAlign)
+                results['utils'].append(tUtils)
+        results['in memory'].append(timeInMemory(inFiles, rightAlign))
+
+    for legacyFile, utilsFile in zip(legacyFiles, utilsFiles):
+        if not filecmp.cmp(legacyFile, utilsFile, shallow=False):
+            raise ValueError('Outputs differ: {} {}'.format(legacyFile, utilsFile))
+
+    print('{} ({} files, {} lines)'.format(name, len(inFiles), nLines))
+    tLegacy = statistics.median(results['legacy'])
+    for impl, times in results.items():
+        t = statistics.median(times)
+        print('  {:<10s} {:>12.0f} lines/s  {:>6.2f}x'.format(impl, nLines / t, tLegacy / t))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the PDB columns completion of lephar')
+    parser.add_argument('--atoms', type=int, default=500000, help='Number of atoms of the synthetic receptor')
+    parser.add_argument('--poses', type=int, default=2000, help='Number of synthetic pose files')
+    parser.add_argument('--poseAtoms', type=int, default=40, help='Number of atoms per pose')
+    parser.add_argument('--repeats', type=int, default=7, help='Repetitions of each measure (median is reported)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        recFile = writeSyntheticPDB(os.path.join(tmpDir, 'pro.pdb'), args.atoms)
+        runBenchmark('Receptor (lepro)', [recFile], False, args.repeats)
+
+        poseFiles = writeSyntheticPoses(os.path.join(tmpDir, 'poses'), args.poses, args.poseAtoms)
+        runBenchmark('Poses (ledock)', poseFiles, True, args.repeats)
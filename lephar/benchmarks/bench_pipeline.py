@@ -0,0 +1,231 @@
+# **************************************************************************
+# *
+# * Authors:    Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Offline benchmark of the LeDock docking orchestration using the fake_lephar stand-in binaries and synthetic
+ligand and pocket sets. It measures the throughput of the stages ProtChemLeDock runs around ledock:
+    - schedule: ligand costs and job lists packed longest first (contiguous shards with --noCostOrder), ligand and
+      receptor links, chunk lists and ledock inputs of each pocket, with the same lephar.utils calls as ProtChemLeDock
+    - dock: ledock invocations through lephar.utils.runCommands with a pool of workers (by default the fake ledock
+      does not sleep, so this measures the per invocation and per ligand overhead)
+    - dock pinned (with --pin): the same invocations with each worker pinned to its own CPUs, spread among the NUMA
+      nodes. Use --busy to make the fake ledock compute, so the difference with dock is meaningful. Both dock
+      variants run --repeats times, alternating which goes first and removing the previous .dok files, and the
+      median time of each is reported, so neither benefits from the page cache warmed by the other
+    - split: ledock -spli of every .dok file, multiplexed with runCommands
+    - correct: PDB columns completion and renaming of every pose
+    - output: pose listing and energy parsing, plus the SetOfSmallMolecules construction when pwchem is available
+
+    python -m lephar.benchmarks.bench_pipeline --ligands 1000 10000 100000 --pockets 1 8 64
+    python -m lephar.benchmarks.bench_pipeline --ligands 2000 --pockets 8 --workers 16 --busy 0.01 --pin --repeats 5
+"""
+
+import os, argparse, shutil, statistics, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+from lephar.utils import writeListFile, readListFile, publishListFile, linkLocal, getDockBox, writeDockInput, \
+    moveToSplitDir, getPoseFileName, listPoseFiles, addPDBColumns, runCommands, getWorkerCpuSets, getLigandCosts, \
+    writeCostsFile, readCostsFile, packLongestFirst, parsePoseEnergy
+from lephar.benchmarks.fake_lephar import writeFakeLePharHome
+from lephar.benchmarks.synthetic import writeSyntheticLigands, writeSyntheticPDB, getSyntheticPockets
+
+STAGES = ['schedule', 'dock', 'split', 'correct', 'output']
+PINNED_STAGE = 'dock pinned'
+
+
+def makeShards(items, nShards):
+    '''Contiguous shards, as pwchem makeSubsets (used by ProtChemLeDock without cost ordering)'''
+    size, rest = divmod(len(items), nShards)
+    shards, start = [], 0
+    for i in range(nShards):
+        end = start + size + (1 if i < rest else 0)
+        shards.append(items[start:end])
+        start = end
+    return shards
+
+def runPool(func, items, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+def scheduleStage(workDir, molFiles, recFile, pockets, nShards, nPoses, costOrder=True):
+    '''Writes the ligand lists, links and ledock inputs as ProtChemLeDock does in its convertStep
+    (convertAndWriteMolSet, writeLigandSubsets, doLocalLig) and dockStep (writeChunkList, writeDockInFile) without
+    auto chunking. Returns the (dock input, pocket dir) of the ledock jobs'''
+    ligList = writeListFile(os.path.join(workDir, 'ligands.list'), molFiles)
+    if costOrder:
+        costsFile = writeCostsFile(os.path.join(workDir, 'ligandCosts.tsv'), molFiles, getLigandCosts(molFiles))
+        costsDic = readCostsFile(costsFile)
+        shards = packLongestFirst(molFiles, [costsDic[molFile] for molFile in molFiles], nShards)
+    else:
+        shards = makeShards(molFiles, nShards)
+    for iShard, shard in enumerate(shards):
+        publishListFile(os.path.join(workDir, 'ligandsBase_{}.list'.format(iShard)),
+                        [os.path.basename(molFile) for molFile in shard])
+
+    jobs = []
+    for iPocket, (center, radius) in enumerate(pockets):
+        pDir = os.path.join(workDir, 'pocket_{}'.format(iPocket + 1))
+        os.mkdir(pDir)
+        for molFile in readListFile(ligList):
+            linkLocal(molFile, pDir)
+        for iShard in range(nShards):
+            ligFiles = readListFile(os.path.join(workDir, 'ligandsBase_{}.list'.format(iShard)))
+            chunkList = publishListFile(os.path.abspath(os.path.join(pDir, 'chunk_1_{}_0.list'.format(iShard))),
+                                        ligFiles)
+            localReceptor = linkLocal(recFile, pDir)
+            localLigList = linkLocal(chunkList, pDir)
+            dockFile = writeDockInput(os.path.abspath(os.path.join(pDir, 'dock_{}.in'.format(iShard))),
+                                      localReceptor, 1.0, getDockBox(center, radius), nPoses, localLigList)
+            jobs.append((dockFile, pDir))
+    return jobs
+
+def removeDockFiles(pocketDirs):
+    for pDir in pocketDirs:
+        for entry in os.scandir(pDir):
+            if entry.name.endswith('.dok'):
+                os.remove(entry.path)
+
+def timeDockStage(ledockBin, jobs, pocketDirs, workers, cpuSets=None):
+    '''Docks from scratch, so every run writes the same new .dok files'''
+    removeDockFiles(pocketDirs)
+    start = time.perf_counter()
+    runCommands([([ledockBin, dockFile], pDir) for dockFile, pDir in jobs], workers, cpuSets=cpuSets)
+    return time.perf_counter() - start
+
+def correctFiles(poseFiles):
+    for poseFile in poseFiles:
+        addPDBColumns(poseFile, getPoseFileName(poseFile))
+        os.remove(poseFile)
+    return len(poseFiles)
+
+def buildOutputSet(workDir, poses):
+    try:
+        import pyworkflow.object as pwobj
+        from pwchem.objects import SetOfSmallMolecules, SmallMolecule
+    except ImportError:
+        return False
+
+    outputSet = SetOfSmallMolecules(filename=os.path.join(workDir, 'outputSmallMolecules.sqlite'))
+    for molKey, poseFile, energy in poses:
+        newSmallMol = SmallMolecule(smallMolFilename=poseFile, molName=molKey)
+        newSmallMol._energy = pwobj.Float(energy)
+        newSmallMol.poseFile.set(poseFile)
+        outputSet.append(newSmallMol)
+    outputSet.write()
+    outputSet.close()
+    return True
+
+def runPipeline(workDir, molFiles, nPockets, args, binDir):
+    ledockBin = os.path.join(binDir, 'ledock_linux_x86')
+    recFile = writeSyntheticPDB(os.path.join(workDir, 'pro.pdb'), args.recAtoms)
+    pockets = getSyntheticPockets(nPockets)
+    times, counts = {}, {}
+
+    start = time.perf_counter()
+    jobs = scheduleStage(workDir, molFiles, recFile, pockets, args.shards, args.poses, not args.noCostOrder)
+    times['schedule'], counts['schedule'] = time.perf_counter() - start, len(molFiles) * nPockets
+
+    pocketDirs = [os.path.join(workDir, 'pocket_{}'.format(i + 1)) for i in range(nPockets)]
+    variants = [('dock', None)]
+    if args.pin:
+        variants.append((PINNED_STAGE, getWorkerCpuSets(args.workers)))
+    dockTimes = {stage: [] for stage, _ in variants}
+    for iRepeat in range(args.repeats):
+        # Alternate which variant runs first, so none always finds the files cached by the other
+        for stage, cpuSets in (variants if iRepeat % 2 == 0 else variants[::-1]):
+            dockTimes[stage].append(timeDockStage(ledockBin, jobs, pocketDirs, args.workers, cpuSets))
+    for stage in dockTimes:
+        times[stage], counts[stage] = statistics.median(dockTimes[stage]), len(molFiles) * nPockets
+
+    start = time.perf_counter()
+    splitJobs = []
+    for pDir in pocketDirs:
+        dokFiles = [moveToSplitDir(entry.path, pDir) for entry in os.scandir(pDir) if entry.name.endswith('.dok')]
+        splitJobs += [([ledockBin, '-spli', dokFile], pDir) for dokFile in dokFiles]
+    runCommands(splitJobs, args.workers)
+    for cmd, _ in splitJobs:
+        os.remove(cmd[-1])
+    times['split'], counts['split'] = time.perf_counter() - start, len(splitJobs)
+
+    start = time.perf_counter()
+    poseFiles = []
+    for pDir in pocketDirs:
+        poseFiles += [poseFile for _, poseFile in listPoseFiles(pDir)]
+    counts['correct'] = sum(runPool(correctFiles, makeShards(poseFiles, args.workers), args.workers))
+    times['correct'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    poses = []
+    for pDir in pocketDirs:
+        poses += [(molKey, poseFile, parsePoseEnergy(poseFile)) for molKey, poseFile in listPoseFiles(pDir)]
+    withSet = buildOutputSet(workDir, poses)
+    times['output'], counts['output'] = time.perf_counter() - start, len(poses)
+    return times, counts, withSet
+
+def printResults(nLigands, nPockets, times, counts, withSet, repeats=1):
+    print('{} ligands, {} pockets'.format(nLigands, nPockets))
+    for stage in STAGES[:2] + [PINNED_STAGE] * (PINNED_STAGE in times) + STAGES[2:]:
+        note = ' (without SetOfSmallMolecules, pwchem not available)' if stage == 'output' and not withSet else ''
+        if stage == PINNED_STAGE:
+            note = ' ({:+.1f}% throughput)'.format(100 * (times['dock'] / max(times[stage], 1e-9) - 1))
+        if stage in ('dock', PINNED_STAGE) and repeats > 1:
+            note = ' (median of {}){}'.format(repeats, note)
+        print('  {:<11s} {:>10.2f} s {:>12.0f} items/s{}'.format(stage, times[stage],
+                                                                   counts[stage] / max(times[stage], 1e-9), note))
+    print('  {:<11s} {:>10.2f} s'.format('total', sum(times.values())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmark of the LeDock docking orchestration')
+    parser.add_argument('--ligands', type=int, nargs='+', default=[1000], help='Ligand set sizes')
+    parser.add_argument('--pockets', type=int, nargs='+', default=[1, 4], help='Number of pockets')
+    parser.add_argument('--shards', type=int, default=4, help='Ligand shards (dock jobs) per pocket')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent workers')
+    parser.add_argument('--poses', type=int, default=2, help='Poses per ligand')
+    parser.add_argument('--noCostOrder', action='store_true',
+                        help='Split the ligands in contiguous shards instead of packing them longest first')
+    parser.add_argument('--recAtoms', type=int, default=5000, help='Atoms of the synthetic receptor')
+    parser.add_argument('--sleep', type=float, default=0, help='Fake ledock seconds per ligand')
+    parser.add_argument('--busy', type=float, default=0, help='Fake ledock CPU seconds per ligand')
+    parser.add_argument('--pin', action='store_true',
+                        help='Run the dock stage also with the workers pinned to their own CPUs (Linux)')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs of the dock stage, whose median is reported')
+    parser.add_argument('--tmpDir', default=None, help='Directory where to run the benchmark')
+    args = parser.parse_args()
+
+    os.environ['FAKE_LEDOCK_SLEEP'] = str(args.sleep)
+    os.environ['FAKE_LEDOCK_BUSY'] = str(args.busy)
+    with tempfile.TemporaryDirectory(dir=args.tmpDir) as tmpDir:
+        binDir = writeFakeLePharHome(os.path.join(tmpDir, 'lephar'))
+        for nLigands in args.ligands:
+            molFiles = writeSyntheticLigands(os.path.join(tmpDir, 'ligands_{}'.format(nLigands)), nLigands)
+            for nPockets in args.pockets:
+                workDir = os.path.join(tmpDir, 'run_{}_{}'.format(nLigands, nPockets))
+                os.mkdir(workDir)
+                printResults(nLigands, nPockets, *runPipeline(workDir, molFiles, nPockets, args, binDir),
+                             repeats=args.repeats)
+                shutil.rmtree(workDir)
@@ -0,0 +1,153 @@
+# **************************************************************************
+# *
+# * Authors:    Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Stand-in for the ledock and lepro binaries of LePhar, used to benchmark the docking orchestration without the
+real programs. It reproduces their inputs and outputs (ledock .dok files and -spli pose files, lepro pro.pdb)
+with synthetic poses and energies derived from the ligand names:
+    python fake_lephar.py ledock dock.in
+    python fake_lephar.py ledock -spli ligand.dok
+    python fake_lephar.py lepro receptor.pdb
+
+The time spent per ligand can be set with the FAKE_LEDOCK_SLEEP (seconds per ligand) and
+FAKE_LEDOCK_SLEEP_ATOM (seconds per heavy atom) environment variables, and the CPU time (busy computing over a
+receptor sized buffer, as ledock scoring does) with FAKE_LEDOCK_BUSY (seconds per ligand). As ledock, the
+ligands whose file cannot be read are skipped without writing their .dok file.
+writeFakeLePharHome creates a LEPHAR_HOME like folder whose binaries call this script, so it can also be used
+as the LEPHAR_HOME of the plugin.
+"""
+
+import os, sys, stat, time, zlib
+
+LEDOCK, LEPRO = 'ledock', 'lepro'
+
+
+def readDockInput(dockFile):
+    '''Returns a dictionary with the sections of a ledock input file'''
+    sections, key = {}, None
+    with open(dockFile) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line == 'END':
+                key = None
+            elif key is None:
+                key, sections[line] = line, []
+            else:
+                sections[key].append(line)
+    return sections
+
+def readMol2Atoms(molFile):
+    '''Returns the (name, x, y, z) of the heavy atoms in a mol2 file'''
+    atoms, inAtoms = [], False
+    with open(molFile) as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                inAtoms = line.startswith('@<TRIPOS>ATOM')
+            elif inAtoms and line.strip():
+                sline = line.split()
+                if sline[5].split('.')[0] != 'H':
+                    atoms.append((sline[1], float(sline[2]), float(sline[3]), float(sline[4])))
+    return atoms
+
+def getFakeEnergy(name, pose):
+    return -2.0 - (zlib.crc32(name.encode()) % 800) / 100.0 + 0.3 * pose
+
+def busyWork(seconds, bufferSize=1 << 24):
+    '''Keeps a CPU and its memory bandwidth busy for some seconds'''
+    buffer, end = bytearray(bufferSize), time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(buffer[::64])
+
+def runLeDock(dockFile):
+    sections = readDockInput(dockFile)
+    center = [sum(map(float, line.split())) / 2 for line in sections['Binding pocket']]
+    nPoses = int(sections['Number of binding poses'][0])
+    sleep, sleepAtom = float(os.environ.get('FAKE_LEDOCK_SLEEP', 0)), float(os.environ.get('FAKE_LEDOCK_SLEEP_ATOM', 0))
+    busy = float(os.environ.get('FAKE_LEDOCK_BUSY', 0))
+
+    with open(sections['Ligands list'][0]) as fList:
+        ligFiles = [line.strip() for line in fList if line.strip()]
+
+    for ligFile in ligFiles:
+        if not os.path.exists(ligFile):
+            continue
+        atoms = readMol2Atoms(ligFile)
+        time.sleep(sleep + sleepAtom * len(atoms))
+        if busy:
+            busyWork(busy)
+        name = os.path.splitext(os.path.basename(ligFile))[0]
+        with open(os.path.splitext(ligFile)[0] + '.dok', 'w') as f:
+            for pose in range(nPoses):
+                f.write('REMARK {}\n'.format(ligFile))
+                f.write('REMARK Cluster {:>3d} of Poses: {:>3d} Score: {:>6.2f} kcal/mol\n'.
+                        format(pose + 1, nPoses, getFakeEnergy(name, pose)))
+                for i, (aName, x, y, z) in enumerate(atoms):
+                    f.write('ATOM  {:5d}  {:<3s} LIG     0    {:8.3f}{:8.3f}{:8.3f}\n'.
+                            format(i + 1, aName[:3], x + center[0] + pose, y + center[1], z + center[2]))
+                f.write('END\n')
+
+def splitDock(dokFile):
+    root = os.path.splitext(dokFile)[0]
+    pose, lines = 0, []
+    with open(dokFile) as f:
+        for line in f:
+            lines.append(line)
+            if line.startswith('END'):
+                pose += 1
+                with open('{}_dock{:03d}.pdb'.format(root, pose), 'w') as fPose:
+                    fPose.write(''.join(lines))
+                lines = []
+
+def runLePro(pdbFile):
+    with open(pdbFile) as fIn:
+        with open('pro.pdb', 'w') as f:
+            for line in fIn:
+                if line.startswith('ATOM') or line.startswith('END'):
+                    f.write(line[:54].rstrip() + '\n')
+
+def writeFakeLePharHome(homeDir):
+    '''Creates a LEPHAR_HOME like folder whose binaries run this script. Returns the bin folder'''
+    binDir = os.path.join(homeDir, 'bin')
+    os.makedirs(binDir, exist_ok=True)
+    for program in [LEDOCK, LEPRO]:
+        binFile = os.path.join(binDir, program + '_linux_x86')
+        with open(binFile, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, os.path.abspath(__file__), program))
+        os.chmod(binFile, os.stat(binFile).st_mode | stat.S_IEXEC)
+    return binDir
+
+
+if __name__ == "__main__":
+    program, args = sys.argv[1], sys.argv[2:]
+    if program == LEDOCK and args[0] == '-spli':
+        splitDock(args[1])
+    elif program == LEDOCK:
+        runLeDock(args[0])
+    elif program == LEPRO:
+        runLePro(args[0])
+    else:
+        sys.exit('Unknown program {}'.format(program))
@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# * Authors:    Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Generators of synthetic inputs and outputs of the LePhar programs used by the benchmarks
+"""
+
+import os, random
+
+MOL2_TYPES = ['C.3', 'C.3', 'C.ar', 'C.ar', 'C.2', 'N.am', 'N.ar', 'O.2', 'O.3', 'S.3', 'F', 'Cl']
+ATOM_NAMES = ['N', 'CA', 'C', 'O', 'CB', 'CG1', 'CG2', 'OD1', 'ND2', 'NZ', 'SG', 'CL1', 'BR1']
+PDB_ATOM_LINE = 'ATOM  {:5d}  {:<3s} {:>3s} {:1s}{:4d}    {:8.3f}{:8.3f}{:8.3f}\n'
+
+def getSyntheticAtomLines(nAtoms, resName='ALA', chain='A', seed=0):
+    '''Returns a list of PDB ATOM lines (as written by lepro or ledock, without occupancy, B-factor and element)'''
+    rand = random.Random(seed)
+    lines = []
+    for i in range(nAtoms):
+        lines.append(PDB_ATOM_LINE.format(i % 100000 + 1, ATOM_NAMES[i % len(ATOM_NAMES)], resName, chain,
+                                          i // 10 % 10000 + 1, rand.uniform(-50, 50), rand.uniform(-50, 50),
+                                          rand.uniform(-50, 50)))
+    return lines
+
+def writeSyntheticPDB(pdbFile, nAtoms, seed=0):
+    '''Writes a synthetic receptor PDB file of nAtoms'''
+    with open(pdbFile, 'w') as f:
+        f.write('REMARK synthetic receptor\n')
+        f.write(''.join(getSyntheticAtomLines(nAtoms, seed=seed)))
+        f.write('END\n')
+    return pdbFile
+
+def writeSyntheticPose(poseFile, nAtoms, energy=-5.0, seed=0):
+    '''Writes a synthetic LeDock pose PDB file, as produced by ledock -spli'''
+    with open(poseFile, 'w') as f:
+        f.write('REMARK {}\n'.format(os.path.basename(poseFile)))
+        f.write('REMARK Cluster   1 of Poses: 1 Score: {:.2f} kcal/mol\n'.format(energy))
+        f.write(''.join(getSyntheticAtomLines(nAtoms, resName='LIG', chain=' ', seed=seed)))
+        f.write('END\n')
+    return poseFile
+
+def writeSyntheticPoses(outDir, nPoses, nAtoms):
+    '''Writes nPoses synthetic pose files in outDir and returns their paths'''
+    os.makedirs(outDir, exist_ok=True)
+    return [writeSyntheticPose(os.path.join(outDir, 'lig{}_dock{:03d}.pdb'.format(i, 1)), nAtoms, seed=i)
+            for i in range(nPoses)]
+
+def writeSyntheticMol2(molFile, nAtoms, seed=0):
+    '''Writes a synthetic ligand mol2 file of nAtoms heavy atoms: a chain with a ring closure every 6 atoms'''
+    rand = random.Random(seed)
+    name = os.path.splitext(os.path.basename(molFile))[0]
+    bonds = [(i, i + 1, '1') for i in range(1, nAtoms)]
+    bonds += [(i - 5, i, 'ar') for i in range(6, nAtoms + 1, 6)]
+
+    with open(molFile, 'w') as f:
+        f.write('@<TRIPOS>MOLECULE\n{}\n {} {} 0 0 0\nSMALL\nGASTEIGER\n\n@<TRIPOS>ATOM\n'.
+                format(name, nAtoms, len(bonds)))
+        for i in range(1, nAtoms + 1):
+            aType = MOL2_TYPES[rand.randrange(len(MOL2_TYPES))]
+            f.write('{:>7d} {:<4s}{:>14.4f}{:>10.4f}{:>10.4f} {:<8s}1  LIG1        0.0000\n'.
+                    format(i, aType.split('.')[0] + str(i), rand.uniform(-5, 5), rand.uniform(-5, 5),
+                           rand.uniform(-5, 5), aType))
+        f.write('@<TRIPOS>BOND\n')
+        for i, (a, b, bType) in enumerate(bonds):
+            f.write('{:>6d}{:>6d}{:>6d}    {}\n'.format(i + 1, a, b, bType))
+    return molFile
+
+def writeSyntheticLigands(outDir, nLigands, minAtoms=10, maxAtoms=60, seed=0):
+    '''Writes nLigands synthetic mol2 files in outDir and returns their paths'''
+    rand = random.Random(seed)
+    os.makedirs(outDir, exist_ok=True)
+    return [writeSyntheticMol2(os.path.join(outDir, 'lig{}.mol2'.format(i)), rand.randint(minAtoms, maxAtoms),
+                               seed=seed + i) for i in range(nLigands)]
+
+def getSyntheticPockets(nPockets, seed=0):
+    '''Returns a list of (center, radius) of synthetic pockets'''
+    rand = random.Random(seed)
+    return [((rand.uniform(-30, 30), rand.uniform(-30, 30), rand.uniform(-30, 30)), rand.uniform(6, 12))
+            for _ in range(nPockets)]
@@ -48,4 +48,14 @@ DESC_CHOICES = ['HeavyAtomCount', 'MolLogP', 'NumHAcceptors', 'NumHDonors', 'Num
                 'NumChiralCenters', 'RingCount', 'NOCount', 'TPSA', 'FractionCSP3', 'NumAromaticRings',
                 'NumSaturatedRings', 'NumAliphaticRings', 'NumAromaticHeterocycles', 'NumSaturatedHeterocycles',
                 'NumAliphaticHeterocycles', 'NumAromaticCarbocycles', 'NumSaturatedCarbocycles',
-                'NumAliphaticCarbocycles']
\ No newline at end of file
+                'NumAliphaticCarbocycles']
+COMPRESSION_CHOICES = ['None', 'gzip', 'zstd']
+
+# Ligands docked alone by each job to measure the ledock startup overhead when auto tuning the chunk size
+CALIBRATION_LIGANDS = 3
+
+# Seconds between the docking progress reports
+PROGRESS_PERIOD = 300
+
+# Molecule files per obabel call computing their InChIKeys, bounding the length of its command line
+INCHIKEY_BATCH = 1000
@@ -26,4 +26,5 @@
 
 from .protocol_ledock import ProtChemLeDock
 from .protocol_prepare_target import ProtChemLePro
+from .protocol_filter_descriptors import ProtChemLePharFilter
 #from .protocol_cluster_substructures import * # clustering not ready
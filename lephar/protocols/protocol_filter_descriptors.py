@@ -0,0 +1,181 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json
+import numpy as np
+
+from pwem.protocols import EMProtocol
+from pyworkflow.protocol.params import PointerParam, FloatParam, EnumParam, TextParam, PathParam, LEVEL_ADVANCED
+
+from pwchem.utils import runInParallel, obabelMolConversion, makeSubsets
+from pwchem.objects import SetOfSmallMolecules
+
+from lephar import Plugin as lephar_plugin
+from lephar.constants import DESC_CHOICES
+from lephar.utils import readListFile, writeListFile, getFileHash, readDescriptorsFile, appendDescriptorsFile, \
+    parseFiltersList
+
+# Formats read directly by the descriptors script, the rest are converted to mol2
+RDKIT_EXTS = ['.mol2', '.sdf', '.mol', '.pdb', '.smi']
+DESCRIPTORS_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts',
+                                  'rdkit_descriptors.py')
+
+
+class ProtChemLePharFilter(EMProtocol):
+    """Filters a set of small molecules by ranges of RDKit descriptors, so the molecules out of them are not docked"""
+    _label = 'Descriptors filter'
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        group = form.addGroup('Input')
+        group.addParam('inputSmallMolecules', PointerParam, pointerClass="SetOfSmallMolecules",
+                       label='Input small molecules: ',
+                       help="Input set of small molecules to filter")
+
+        group = form.addGroup('Filters')
+        group.addParam('descriptor', EnumParam, choices=DESC_CHOICES, default=0, label='Descriptor: ',
+                       help='RDKit descriptor to filter by')
+        group.addParam('minValue', FloatParam, default=0, label='Minimum value: ',
+                       help='Minimum value of the descriptor to keep a molecule')
+        group.addParam('maxValue', FloatParam, default=10, label='Maximum value: ',
+                       help='Maximum value of the descriptor to keep a molecule')
+        group.addParam('filtersList', TextParam, width=70, default='', label='List of filters: ',
+                       help='Descriptor filters to apply. Use the wizard to add the descriptor with its range. '
+                            'Only the molecules with all the descriptors in range are kept')
+        group.addParam('descCache', PathParam, default='', label='Descriptors cache file: ',
+                       expertLevel=LEVEL_ADVANCED,
+                       help='File where the computed descriptors are stored by molecule file hash, so they are '
+                            'reused by later runs with the same molecules. If empty, they are only stored in this '
+                            'protocol.')
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('descriptorsStep')
+        self._insertFunctionStep('createOutputStep')
+
+    def descriptorsStep(self):
+        molFiles = self.getMolFiles()
+        hashes = [getFileHash(molFile) for molFile in molFiles]
+        writeListFile(self.getHashesFile(), hashes)
+
+        # Descriptors computed once per unique molecule file and only if not cached
+        descNames = self.getDescriptorNames()
+        known, missing = readDescriptorsFile(self.getCacheFile()), {}
+        for molHash, molFile in zip(hashes, molFiles):
+            if molHash not in missing and not all(descName in known.get(molHash, {}) for descName in descNames):
+                missing[molHash] = molFile
+
+        if missing:
+            nJobs = min(self.numberOfThreads.get(), len(missing))
+            argsList = []
+            for i, subset in enumerate(makeSubsets(list(missing.items()), nJobs, cloneItem=False)):
+                inList = writeListFile(os.path.abspath(self._getExtraPath('descInput_{}.list'.format(i))),
+                                       ['{}\t{}'.format(molHash, molFile) for molHash, molFile in subset])
+                argsList.append([inList, os.path.abspath(self._getExtraPath('descOutput_{}.tsv'.format(i))),
+                                 ','.join(descNames)])
+            lephar_plugin.runRDKit2Jobs(DESCRIPTORS_SCRIPT, argsList, [self._getExtraPath()] * len(argsList),
+                                        maxJobs=nJobs)
+            newValues = {}
+            for args in argsList:
+                newValues.update(readDescriptorsFile(args[1]))
+                os.remove(args[0]), os.remove(args[1])
+            appendDescriptorsFile(self.getCacheFile(), newValues)
+
+    def createOutputStep(self):
+        filters = self.getFilters()
+        values = readDescriptorsFile(self.getCacheFile())
+        hashes = readListFile(self.getHashesFile())
+
+        # Molecules x filters matrix of values, compared at once with the ranges (NaN values never pass)
+        valMatrix = np.array([[values[molHash].get(descName, np.nan) for descName, _, _ in filters]
+                              for molHash in hashes], dtype=float).reshape(len(hashes), len(filters))
+        inRange = (valMatrix >= np.array([f[1] for f in filters])) & (valMatrix <= np.array([f[2] for f in filters]))
+        passed = np.all(inRange, axis=1)
+
+        nFailed = {descName: int((~inRange[:, i]).sum()) for i, (descName, _, _) in enumerate(filters)}
+        with open(self.getCountsFile(), 'w') as f:
+            json.dump({'nInput': len(hashes), 'nPassed': int(passed.sum()), 'nFailed': nFailed}, f)
+
+        outputSet = SetOfSmallMolecules().create(outputPath=self._getPath())
+        for mol, molPassed in zip(self.inputSmallMolecules.get(), passed):
+            if molPassed:
+                outputSet.append(mol.clone())
+        self._defineOutputs(outputSmallMolecules=outputSet)
+
+    ########################### Validation functions #######################
+
+    def _validate(self):
+        errors = []
+        if not self.filtersList.get() or not self.filtersList.get().strip():
+            errors.append('You need to add at least a filter to the list. You may use the wizard to do so')
+        return errors
+
+    def _summary(self):
+        summary = []
+        if os.path.exists(self.getCountsFile()):
+            with open(self.getCountsFile()) as f:
+                counts = json.load(f)
+            summary.append('{} out of {} molecules passed the filters'.format(counts['nPassed'], counts['nInput']))
+            for descName, nFailed in counts['nFailed'].items():
+                summary.append('{}: {} molecules out of range'.format(descName, nFailed))
+        return summary
+
+    ########################### Utils functions ############################
+
+    def getFilters(self):
+        return parseFiltersList(self.filtersList.get())
+
+    def getDescriptorNames(self):
+        return list(set([descName for descName, _, _ in self.getFilters()]))
+
+    def getCacheFile(self):
+        return self.descCache.get() if self.descCache.get() else os.path.abspath(self._getExtraPath('descriptors.tsv'))
+
+    def getHashesFile(self):
+        return self._getExtraPath('molHashes.list')
+
+    def getCountsFile(self):
+        return self._getExtraPath('filterCounts.json')
+
+    def getMolFiles(self):
+        '''Returns the molecule files to compute the descriptors of, in the input set order, converting to mol2 the
+        ones in formats not read by the descriptors script'''
+        mols = [mol.clone() for mol in self.inputSmallMolecules.get()]
+        toConvert = [mol for mol in mols if os.path.splitext(mol.getFileName())[1] not in RDKIT_EXTS]
+        convFiles = {}
+        if toConvert:
+            for convFile in runInParallel(obabelMolConversion, '.mol2', os.path.abspath(self._getExtraPath()),
+                                          paramList=toConvert, jobs=self.numberOfThreads.get()):
+                convFiles[os.path.splitext(os.path.basename(convFile))[0]] = convFile
+
+        molFiles = []
+        for mol in mols:
+            molFile, ext = os.path.splitext(mol.getFileName())
+            molFiles.append(os.path.abspath(mol.getFileName()) if ext in RDKIT_EXTS
+                            else convFiles[os.path.basename(molFile)])
+        return molFiles
@@ -24,19 +24,36 @@
 # *
 # **************************************************************************
 
-import os, time
+import os, json, math, shutil, threading, time
 
 from pwem.convert import AtomicStructHandler
 from pwem.protocols import EMProtocol
-from pyworkflow.protocol.params import PointerParam, IntParam, FloatParam, STEPS_PARALLEL, BooleanParam, LEVEL_ADVANCED
+from pyworkflow.protocol.params import PointerParam, IntParam, FloatParam, STEPS_PARALLEL, BooleanParam, LEVEL_ADVANCED, \
+    PathParam, StringParam, EnumParam
 import pyworkflow.object as pwobj
 
+import numpy as np
 
-from pwchem.utils import removeNumberFromStr, performBatchThreading, runInParallel, obabelMolConversion, makeSubsets
+from pwchem.utils import performBatchThreading, runInParallel, obabelMolConversion, makeSubsets, runOpenBabel
 from pwchem.objects import SetOfSmallMolecules, SmallMolecule
 
 from lephar import Plugin as lephar_plugin
 from lephar.constants import *
+from lephar.utils import getLigandKey, readListFile, writeListFile, clusterMolFiles, \
+    writeClustersFile, readClustersFile, selectBestEnergies, addPDBColumns, linkLocal, getDockBox, writeDockInput, \
+    moveToSplitDir, getPoseFileName, listPoseFiles, timeStage, getLigandDockTimes, writeLigandTimes, \
+    summarizeProfile, getLigandCosts, readLigandTimes, packLongestFirst, writeCostsFile, readCostsFile, \
+    runLeDockWatched, getScratchRoot, stageScratchDir, packDockResults, extractDockArchives, readPocketDockEnergies, \
+    isDockFile, compressDockFiles, isZstdAvailable, packMolLibrary, extractFromMolLibrary, groupByKey, \
+    COMPRESSION_EXTS, copyFiles, publishListFile, claimFile, estimateInvocationOverhead, getOptimalChunkSize, \
+    getSpreadSample, DockProgress, countProfileLigands, countListsLigands, formatDuration, isSplitPoseFile, \
+    planDockJobs, summarizeDockPlan, CpuSlots, isAffinityAvailable, parsePoseEnergy
+from lephar.scoring import ScoreTable, cropReceptor, readPoseCoords, selectDistinctPoses
+
+# Guards the creation of the docking progress monitor and CPU slots by the first dock step
+_progressLock = threading.Lock()
+# Guards the output set updates, published from the main thread while docking and completed by the output step
+_outputLock = threading.Lock()
 
 
 class ProtChemLeDock(EMProtocol):
@@ -54,10 +71,19 @@ class ProtChemLeDock(EMProtocol):
         group = form.addGroup('Input')
         group.addParam('wholeProt', BooleanParam, label='Dock on whole protein: ', default=False,
                       help='Whether to dock on a whole protein surface or on specific regions')
+        group.addParam('doEnsemble', BooleanParam, label='Dock on a receptor ensemble: ', default=False,
+                       help='Whether to dock the ligands on a set of receptor conformations in the same run. '
+                            'Ligands are converted only once and the best score per ligand across the ensemble '
+                            'is reported. The poses docked on each receptor are in its own output set.')
+        group.addParam('inputReceptors', PointerParam, pointerClass="SetOfAtomStructs",
+                       label='Receptor ensemble:', condition='doEnsemble', allowsNull=True,
+                       help="The set of atom structures to use as receptors in the docking. When docking on "
+                            "structural ROIs, the ROIs are used in every receptor, so these must be aligned to "
+                            "the ROIs protein.")
 
         #Docking on whole protein
         group.addParam('inputAtomStruct', PointerParam, pointerClass="AtomStruct",
-                      label='Input atomic structure:', condition='wholeProt', allowsNull=True,
+                      label='Input atomic structure:', condition='wholeProt and not doEnsemble', allowsNull=True,
                       help="The atom structure to use as receptor in the docking")
         group.addParam('radius', FloatParam, label='Grid radius for whole protein: ',
                        condition='wholeProt', allowsNull=False,
@@ -79,99 +105,492 @@ class ProtChemLeDock(EMProtocol):
                        help='RMSD threshold for discarding too similar docking poses')
         group.addParam('nRuns', IntParam, label='Number of positions per ligand: ', default=10,
                        help='Maximum number of poses to output per ligand per StructROI')
+        group.addParam('cropReceptor', BooleanParam, label='Crop receptor around the ROIs: ', default=False,
+                       condition='not wholeProt', expertLevel=LEVEL_ADVANCED,
+                       help='Dock each structural ROI on a copy of the receptor with only the residues having atoms '
+                            'inside its docking box plus a margin, so ledock reads and processes fewer atoms. '
+                            'Recommended for ROIs in large complexes.')
+        group.addParam('cropMargin', FloatParam, label='Cropping margin (A): ', default=8.0,
+                       condition='not wholeProt and cropReceptor', expertLevel=LEVEL_ADVANCED,
+                       help='Distance added to each side of the docking box to select the residues to keep')
+        group.addParam('crossDedup', BooleanParam, label='Remove duplicate poses across ROIs: ', default=False,
+                       condition='not wholeProt', expertLevel=LEVEL_ADVANCED,
+                       help='Compare the poses of each ligand obtained in the different structural ROIs (of the '
+                            'same receptor) and keep only the best scored one of those closer than the cluster '
+                            'RMSD. Useful when the ROIs overlap.')
+        group.addParam('doDedup', BooleanParam, label='Dock unique molecules once: ', default=False,
+                       help='Identify the input molecules by their InChIKey and dock only one of each group of '
+                            'duplicates or conformers of the same molecule, since ledock samples the ligand '
+                            'flexibility itself. The poses are then assigned to all the equivalent input molecules.')
+
+        form.addSection(label='Screening')
+        group = form.addGroup('Funnel docking')
+        group.addParam('doFunnel', BooleanParam, label='Cluster funnel docking: ', default=False,
+                       help='Cluster the ligand library and dock only the cluster representatives first. Then, '
+                            'the rest of members of the best scoring clusters are docked in each pocket.\n'
+                            'Ligands are clustered by the similarity of their atom types and bonds.')
+        group.addParam('funnelCut', FloatParam, label='Clustering similarity cutoff: ', default=0.7,
+                       condition='doFunnel', expertLevel=LEVEL_ADVANCED,
+                       help='Minimum similarity (0 to 1) of a ligand to a cluster representative to be included '
+                            'in its cluster. Higher values produce more clusters and so more docking runs.')
+        group.addParam('funnelTopPerc', FloatParam, label='Expand best clusters (%): ', default=20.0,
+                       condition='doFunnel',
+                       help='Percentage of the clusters with the best representative energies which will be '
+                            'expanded (all its members docked) in each pocket')
+        group.addParam('funnelEnergy', FloatParam, label='Expand clusters under energy (kcal/mol): ',
+                       condition='doFunnel', allowsNull=True, expertLevel=LEVEL_ADVANCED,
+                       help='Clusters whose representative energy is under this value are also expanded, '
+                            'independently of their rank. Leave empty to use only the percentage.')
+
+        group = form.addGroup('Staged docking')
+        group.addParam('doStaged', BooleanParam, label='Coarse then fine docking: ', default=False,
+                       help='Dock first all the ligands producing only a few poses. Then, dock again the best '
+                            'scoring ligands in each pocket with the full number of positions per ligand, '
+                            'replacing their coarse results in the output.')
+        group.addParam('coarseRuns', IntParam, label='Number of positions in coarse stage: ', default=1,
+                       condition='doStaged',
+                       help='Maximum number of poses to output per ligand per StructROI in the coarse stage')
+        group.addParam('fineTopPerc', FloatParam, label='Refine best ligands (%): ', default=10.0,
+                       condition='doStaged',
+                       help='Percentage of the ligands with the best coarse energies in each pocket which will be '
+                            'docked again with the full number of positions')
+
+        group = form.addGroup('Partial results')
+        group.addParam('publishPartial', BooleanParam, label='Publish results while docking: ', default=False,
+                       help='Split and correct the poses of each ligand chunk as soon as it is docked and '
+                            'periodically add them to the output set, which stays open until the docking finishes. '
+                            'This way, the first results can be analysed (or the screen stopped) before the whole '
+                            'library is docked. With funnel or staged docking, only the second stage poses are '
+                            'published early.')
+        group.addParam('publishPeriod', FloatParam, label='Publication period (min): ', default=10.0,
+                       condition='publishPartial', expertLevel=LEVEL_ADVANCED,
+                       help='Minimum time between two updates of the output set')
+
+        group = form.addGroup('Planning')
+        group.addParam('dryRun', BooleanParam, label='Dry run: ', default=False,
+                       help='Do not dock the library. Instead, compute the plan of the screen (docking jobs, ledock '
+                            'invocations and output files) and estimate its CPU time by docking a small sample of '
+                            'the ligands in every pocket. The plan is shown in the summary and saved in the extra '
+                            'folder as plan.json.')
+        group.addParam('dryRunSample', IntParam, label='Calibration ligands: ', default=10,
+                       condition='dryRun', expertLevel=LEVEL_ADVANCED,
+                       help='Number of ligands, evenly taken from the input set, docked in each pocket to estimate '
+                            'the time per ligand and the ledock startup time')
+
+        group = form.addGroup('Scheduling')
+        group.addParam('costOrder', BooleanParam, label='Dock most expensive ligands first: ', default=True,
+                       expertLevel=LEVEL_ADVANCED,
+                       help='Estimate the docking cost of each ligand from its heavy atoms and rotatable bonds and '
+                            'distribute the ligands among the docking jobs longest first, so the jobs are balanced '
+                            'and the last ligands docked are the cheapest ones.')
+        group.addParam('costProfile', PathParam, label='Timings of a previous run: ', allowsNull=True,
+                       condition='costOrder', expertLevel=LEVEL_ADVANCED,
+                       help='profile_ligands.csv file from the extra folder of a previous LeDock run. The cost '
+                            'model is fitted to its timings and the measured times are used for the ligands '
+                            'already docked.')
+        group.addParam('ligTimeout', FloatParam, label='Time limit per ligand (min): ', default=0,
+                       expertLevel=LEVEL_ADVANCED,
+                       help='If a single ligand takes longer than this time, its ledock execution is killed and '
+                            'restarted with the rest of the ligands, while the ligand is quarantined (not docked and '
+                            'listed in the summary). Use 0 for no limit.')
+        group.addParam('autoChunk', BooleanParam, label='Auto tune chunk size: ', default=False,
+                       expertLevel=LEVEL_ADVANCED,
+                       help='Each ledock run reads the receptor and computes its grid before docking its ligands. '
+                            'With this option, each docking job first docks a few ligands to measure that overhead '
+                            'and the time per ligand, and splits the rest of its ligands in chunks of the size that '
+                            'balances both. The jobs that finish early dock the chunks not started by the other '
+                            'jobs of the pocket. The chosen sizes are printed in the run log.')
+
+        group.addParam('pinCpus', BooleanParam, label='Pin docking jobs to CPUs: ', default=False,
+                       expertLevel=LEVEL_ADVANCED,
+                       help='Pin each of the concurrent ledock executions to its own set of CPUs, spreading them '
+                            'among the NUMA nodes (sockets) of the machine, so the system does not migrate them '
+                            'and each one uses the memory of its node. Linux only.')
+
+        group = form.addGroup('Storage')
+        group.addParam('packLibrary', BooleanParam, label='Packed ligand library: ', default=False,
+                       expertLevel=LEVEL_ADVANCED,
+                       help='Store the converted ligands in a single library file with an index of their positions, '
+                            'instead of a file per ligand linked into every pocket. Each docking job slices its '
+                            'ligands from the library when it starts and removes them when it finishes.')
+        group.addParam('useScratch', BooleanParam, label='Dock in local scratch: ', default=False,
+                       expertLevel=LEVEL_ADVANCED,
+                       help='Run each docking job in a local scratch directory, with the receptor and its ligands '
+                            'copied in, and copy back only an archive with its results. Recommended when the '
+                            'project is in a network file system.')
+        group.addParam('scratchDir', StringParam, label='Scratch directory: ', default='',
+                       condition='useScratch', expertLevel=LEVEL_ADVANCED,
+                       help='Local directory where the docking jobs are run. If empty, $TMPDIR or the system '
+                            'temporary directory is used.')
+        group.addParam('compression', EnumParam, label='Compress docking files: ', default=0,
+                       choices=COMPRESSION_CHOICES, expertLevel=LEVEL_ADVANCED,
+                       help='Compress the ledock .dok files once each job finishes. They are read compressed '
+                            'and only decompressed to split them. zstd needs the zstandard python package.')
+        group.addParam('compressPoses', BooleanParam, label='Compress output poses: ', default=False,
+                       condition='compression!=0', expertLevel=LEVEL_ADVANCED,
+                       help='Store the output pose files compressed too (e.g: pose_1.pdb.gz). Programs reading '
+                            'them afterwards must support the compression format.')
 
         form.addParallelSection(threads=4, mpi=1)
 
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
+        if self.dryRun:
+            self._insertFunctionStep('planStep')
+            return
+
         nThreads = self.getnThreads()
         cId = self._insertFunctionStep('convertStep', prerequisites=[])
 
         dockSteps, splitSteps = [], []
-        if self.wholeProt:
-            pocketDir = self.getOutputPocketDir()
+        for recId, pocket in self.getTargets():
+            pocketDir = self.getOutputPocketDir(pocket, recId)
             os.mkdir(pocketDir)
+            pocketSteps = []
             for i in range(nThreads):
-                dockId = self._insertFunctionStep('dockStep', None, i, poprerequisites=[cId])
-            dockSteps.append(dockId)
+                dockId = self._insertFunctionStep('dockStep', pocket, i, 1, recId, prerequisites=[cId])
+                pocketSteps.append(dockId)
+            dockSteps += pocketSteps
 
-            splitId = self._insertFunctionStep('splitStep', None, nThreads, prerequisites=dockSteps)
-            splitSteps.append(splitId)
-            
-        else:
-            for pocket in self.inputStructROIs.get():
-                pocketDir = self.getOutputPocketDir(pocket)
-                os.mkdir(pocketDir)
+            if self.doFunnel or self.doStaged:
+                selectStep = 'funnelStep' if self.doFunnel else 'refineStep'
+                sId = self._insertFunctionStep(selectStep, pocket, nThreads, recId, prerequisites=pocketSteps)
                 for i in range(nThreads):
-                    dockId = self._insertFunctionStep('dockStep', pocket.clone(), i, prerequisites=[cId])
+                    dockId = self._insertFunctionStep('dockStep', pocket, i, 2, recId, prerequisites=[sId])
                     dockSteps.append(dockId)
-                    
-            for pocket in self.inputStructROIs.get():
-                splitId = self._insertFunctionStep('splitStep', pocket.clone(), nThreads, prerequisites=dockSteps)
-                splitSteps.append(splitId)
-                
+
+        for recId, pocket in self.getTargets():
+            splitId = self._insertFunctionStep('splitStep', pocket, nThreads, recId, prerequisites=dockSteps)
+            splitSteps.append(splitId)
+
         self._insertFunctionStep('createOutputStep', prerequisites=splitSteps)
 
     def convertStep(self):
         outDir = self._getExtraPath()
-        #Receptor as prepared by lepro
-        lephar_plugin.runLePhar(self, 'lepro', args=os.path.abspath(self.getOriginalReceptorFile()), cwd=outDir)
+        self.prepareDockReceptors()
+
+        # Ligands in mol2 format, converted once and shared by all receptors and pockets
+        with self.timeStage('convert'):
+            self.convertAndWriteMolSet(self.inputSmallMolecules.get(), outDir, self.numberOfThreads.get())
+        if not self.packLibrary:
+            with self.timeStage('staging'):
+                for recId, pocket in self.getTargets():
+                    self.doLocalLig(self.getOutputPocketDir(pocket, recId))
+
+    def dockStep(self, pocket=None, idx=None, stage=1, recId=None):
+        oDir = self.getOutputPocketDir(pocket, recId)
+        jobKey = '{}_{}'.format(os.path.basename(oDir), self.getJobName(idx, stage))
+        ligFiles = readListFile(self.getLigandListFile(base=True, idx=idx, pocket=pocket, stage=stage, recId=recId))
+        if not ligFiles and not self.autoChunk:
+            return
+
+        with self.timeStage('staging', jobKey):
+            workDir = oDir
+            if self.useScratch:
+                # Receptor copied into the local job directory, and the ligands of each chunk before docking it
+                workDir = stageScratchDir(getScratchRoot(self.scratchDir.get()), jobKey + '_',
+                                          [self.getDockReceptorFile(pocket, recId)])
+
+        try:
+            with self.getCpuSlots().slot() as cpus:
+                if cpus is not None:
+                    print('Docking job {} pinned to CPUs {}'.format(jobKey, ','.join(map(str, sorted(cpus)))))
+                if self.autoChunk and ligFiles:
+                    # A few ligands spread along the job (which may be sorted by cost) are docked alone to
+                    # measure the ledock startup overhead and choose the chunk size
+                    calFiles, rest = getSpreadSample(ligFiles, CALIBRATION_LIGANDS)
+                    calList = self.writeChunkList(oDir, stage, idx, 0, calFiles, claim=True)
+                    ligTimes = self.dockChunk(pocket, idx, stage, recId, calList, workDir, jobKey, cpus)
+                    chunkSize = self.calibrateChunkSize(jobKey, ligTimes, rest)
+                    for iChunk, iStart in enumerate(range(0, len(rest), chunkSize)):
+                        self.writeChunkList(oDir, stage, idx, iChunk + 1, rest[iStart:iStart + chunkSize])
+                elif ligFiles:
+                    self.writeChunkList(oDir, stage, idx, 0, ligFiles)
+
+                # Own chunks first and then, with auto chunking, the ones not started yet of the other jobs
+                for chunkList in self.getPendingChunks(oDir, stage, idx):
+                    if claimFile(chunkList):
+                        self.dockChunk(pocket, idx, stage, recId, chunkList, workDir, jobKey, cpus)
+
+            if self.useScratch:
+                with self.timeStage('archive', jobKey):
+                    packDockResults(workDir, os.path.join(oDir, 'docks_{}_{}.tar'.format(stage, idx)))
+        finally:
+            if self.useScratch:
+                shutil.rmtree(workDir, ignore_errors=True)
+
+    def dockChunk(self, pocket, idx, stage, recId, chunkList, workDir, jobKey, cpus=None):
+        '''Docks the ligands of a chunk list in the job directory, pinned to cpus if given. Returns the
+        (dokFile, seconds) of its ligands'''
+        oDir = self.getOutputPocketDir(pocket, recId)
+        chunkKey = '{}_{}'.format(jobKey, os.path.splitext(os.path.basename(chunkList))[0])
+        ligFiles = readListFile(chunkList)
+        with self.timeStage('staging', chunkKey):
+            stagedFiles = []
+            if self.packLibrary:
+                stagedFiles = extractFromMolLibrary(self.getLibraryFile(), self.getLibraryIndexFile(), ligFiles,
+                                                    workDir)
+            elif self.useScratch:
+                stagedFiles = copyFiles([os.path.join(oDir, ligFile) for ligFile in ligFiles], workDir)
+            dockParamFile, _ = self.writeDockInFile(pocket, idx=idx, stage=stage, recId=recId, ligList=chunkList,
+                                                    workDir=workDir)
+
+        dokFiles = [os.path.join(workDir, getLigandKey(ligFile) + '.dok') for ligFile in ligFiles]
+        progress = self.getDockProgress()
+        try:
+            with self.timeStage('dock', chunkKey) as record:
+                progress.startChunk(chunkKey, os.path.basename(oDir), dokFiles, record['start'])
+                try:
+                    if self.ligTimeout.get():
+                        self.runDockWatched(pocket, idx, stage, recId, ligFiles, workDir, cpus)
+                    else:
+                        lephar_plugin.runLePhar(self, program=self._program, args=dockParamFile, cwd=workDir,
+                                                cpus=cpus)
+                finally:
+                    progress.endChunk(chunkKey)
+            ligTimes = getLigandDockTimes(dokFiles, record['start'])
+            writeLigandTimes(self.getProfileDir(), chunkKey, os.path.basename(oDir), ligTimes)
+            if self.publishPartial and self.isFinalStage(stage):
+                with self.timeStage('split', chunkKey):
+                    self.splitChunk(oDir, chunkKey, dokFiles)
+            elif self.getCompression():
+                compressDockFiles(dokFiles, self.getCompression())
+        finally:
+            for stagedFile in stagedFiles:
+                os.remove(stagedFile)
+        return ligTimes
+
+    def calibrateChunkSize(self, jobKey, ligTimes, restFiles):
+        '''Chooses the chunk size of the rest of ligands of a job from the times of its calibration ligands. With the
+        ligand cost model, the times are normalised by the ligand costs, so the expected time per ligand is the one
+        of the average cost of the rest of ligands'''
+        calCosts, restCost = None, 1.0
+        if self.costOrder and os.path.exists(self.getCostsFile()):
+            costsDic = {getLigandKey(molFile): cost for molFile, cost in readCostsFile(self.getCostsFile()).items()}
+            calCosts = [costsDic.get(getLigandKey(dokFile), 1.0) for dokFile, _ in ligTimes]
+            if restFiles:
+                restCost = sum([costsDic.get(getLigandKey(ligFile), 1.0) for ligFile in restFiles]) / len(restFiles)
+
+        overhead, rate = estimateInvocationOverhead(ligTimes, calCosts)
+        perLigand = rate * restCost if rate is not None else None
+        chunkSize = getOptimalChunkSize(len(restFiles), overhead, perLigand)
+        if overhead is None:
+            print('Chunk size of {}: {} ligands (not enough calibration times)'.format(jobKey, chunkSize))
+        else:
+            print('Chunk size of {}: {} ligands (ledock startup {:.2f} s, {:.2f} s per ligand)'.
+                  format(jobKey, chunkSize, overhead, perLigand))
+        with open(os.path.join(self.getProfileDir(), 'chunks_{}.json'.format(jobKey)), 'w') as f:
+            json.dump({'overhead': overhead, 'perLigand': perLigand, 'chunkSize': chunkSize}, f)
+        return chunkSize
+
+    def planStep(self):
+        '''Computes the plan of the screen and estimates its cost from the docking times of a sample of the ligands
+        in every pocket, without docking the whole library'''
+        planDir = self._getExtraPath('plan')
+        os.mkdir(planDir)
+        for recId, pocket in self.getTargets():
+            os.mkdir(self.getOutputPocketDir(pocket, recId))
+        self.prepareDockReceptors()
+
+        molSet = self.inputSmallMolecules.get()
+        nLigands = len(molSet)
+        nSample = min(self.dryRunSample.get(), nLigands)
+        sampleIdxs = set([i * nLigands // nSample for i in range(nSample)])
+        sample = [mol.clone() for i, mol in enumerate(molSet) if i in sampleIdxs]
+        with self.timeStage('convert', 'plan'):
+            sampleFiles = runInParallel(obabelMolConversion, '.mol2', planDir, paramList=sample,
+                                        jobs=self.numberOfThreads.get())
+        sampleList = writeListFile(os.path.join(planDir, 'sample.list'),
+                                   [os.path.basename(molFile) for molFile in sampleFiles])
+
+        # The sample is docked once in every pocket, concurrently, with the runs of the first stage
+        dockFiles, cwds = [], []
+        for recId, pocket in self.getTargets():
+            calDir = self.getOutputPocketDir(pocket, recId)
+            for molFile in sampleFiles:
+                self.linkLocal(molFile, calDir)
+            dockFiles.append(self.writeDockInFile(pocket, 0, 1, recId, ligList=sampleList, workDir=calDir)[0])
+            cwds.append(calDir)
+        with self.timeStage('dock', 'plan'):
+            results = lephar_plugin.runLePharJobs(self._program, [[dockFile] for dockFile in dockFiles], cwds,
+                                                  maxJobs=self.numberOfThreads.get())
+
+        targets = {}
+        for (recId, pocket), calDir, result in zip(self.getTargets(), cwds, results):
+            dokFiles = [os.path.join(calDir, getLigandKey(molFile) + '.dok') for molFile in sampleFiles]
+            # Timed from the start of its own job: with more targets than threads, the later ones wait for a slot
+            ligTimes = getLigandDockTimes(dokFiles, result.start)
+            writeLigandTimes(self.getProfileDir(), 'plan', os.path.basename(calDir), ligTimes)
+            overhead, perLigand = estimateInvocationOverhead(ligTimes)
+            if perLigand is None:
+                overhead, perLigand = 0.0, sum([t for _, t in ligTimes]) / max(len(ligTimes), 1)
+            center, radius = self.getPocketBox(pocket, recId)
+            targets[os.path.basename(calDir)] = {'boxVolume': (2 * radius) ** 3, 'overhead': overhead,
+                                                 'perLigand': perLigand, 'calibrationSeconds': result.elapsed,
+                                                 'stages': self.getStagesPlan(nLigands, overhead, perLigand)}
+
+        plan = summarizeDockPlan(targets, nLigands, self.numberOfThreads.get(), packLibrary=self.packLibrary.get())
+        plan['sample'] = len(sampleFiles)
+        with open(self.getPlanFile(), 'w') as f:
+            json.dump(plan, f, indent=2)
+        for line in self.getPlanSummary(plan):
+            print(line)
+
+    def funnelStep(self, pocket=None, nThreads=None, recId=None):
+        '''Selects the clusters to expand in a pocket from the energies of their representatives and writes the
+        ligand lists for the second docking stage with the rest of their members'''
+        oDir = self.getOutputPocketDir(pocket, recId)
+        clusters = readClustersFile(self.getClustersFile())
+        dockEnergies = readPocketDockEnergies(oDir)
+        repEnergies = [dockEnergies.get(getLigandKey(members[0])) for members in clusters]
+        expandIdxs = selectBestEnergies(repEnergies, self.funnelTopPerc.get(), self.funnelEnergy.get())
+
+        expandFiles = []
+        for cIdx in expandIdxs:
+            expandFiles += clusters[cIdx][1:]
+        self.writeLigandSubsets(expandFiles, nThreads, pocket=pocket, stage=2, recId=recId)
+
+        with open(self.getStageInfoFile(pocket, recId), 'w') as f:
+            json.dump({'nClusters': len(clusters), 'nExpanded': len(expandIdxs),
+                       'nDocked': len(clusters) + len(expandFiles),
+                       'nLigands': sum([len(members) for members in clusters])}, f)
 
-        # Ligands in mol2 format
-        self.convertAndWriteMolSet(self.inputSmallMolecules.get(), outDir, self.numberOfThreads.get())
+    def refineStep(self, pocket=None, nThreads=None, recId=None):
+        '''Selects the ligands with the best coarse energies in a pocket and writes the ligand lists for the
+        fine docking stage with them'''
+        oDir = self.getOutputPocketDir(pocket, recId)
+        molFiles = readListFile(self.getLigandListFile())
+        dockEnergies = readPocketDockEnergies(oDir)
+        energies = [dockEnergies.get(getLigandKey(molFile)) for molFile in molFiles]
+        refineIdxs = selectBestEnergies(energies, self.fineTopPerc.get())
+        self.writeLigandSubsets([molFiles[i] for i in refineIdxs], nThreads, pocket=pocket, stage=2, recId=recId)
 
-    def dockStep(self, pocket=None, idx=None):
-        oDir = self.getOutputPocketDir(pocket)
-        dockParamFile, _ = self.writeDockInFile(pocket, idx=idx)
-        lephar_plugin.runLePhar(self, program=self._program, args=dockParamFile, cwd=oDir)
+        with open(self.getStageInfoFile(pocket, recId), 'w') as f:
+            json.dump({'nLigands': len(molFiles), 'nRefined': len(refineIdxs)}, f)
 
-    def splitStep(self, pocket=None, nThreads=None):
-        oDir = self.getOutputPocketDir(pocket)
-        dockFiles = self.getDockFiles(oDir)
-        performBatchThreading(self.performSplit, dockFiles, nThreads, cloneItem=False, outDir=oDir)
+    def splitStep(self, pocket=None, nThreads=None, recId=None):
+        self.stopDockProgress()
+        oDir = self.getOutputPocketDir(pocket, recId)
+        with self.timeStage('split', os.path.basename(oDir)):
+            extractDockArchives(oDir)
+            dockFiles = []
+            for dockFile in self.getDockFiles(oDir):
+                if self.publishPartial and os.path.isdir(os.path.join(oDir, getLigandKey(dockFile))):
+                    # Coarse docking of a ligand whose fine docking was already split and published while docking
+                    os.remove(dockFile)
+                else:
+                    dockFiles.append(moveToSplitDir(dockFile, oDir))
+            lephar_plugin.runLePharJobs(self._program, [['-spli', dockFile] for dockFile in dockFiles],
+                                        [oDir] * len(dockFiles), maxJobs=nThreads)
+            for dockFile in dockFiles:
+                os.remove(dockFile)
 
     def createOutputStep(self):
-        allFiles = []
-        for pocketDir in self.getPocketDirs():
-            for file in os.listdir(pocketDir):
-                outDir = os.path.join(pocketDir, file)
-                if os.path.isdir(outDir):
-                    for outFile in os.listdir(outDir):
-                        allFiles.append(os.path.join(outDir, outFile))
-        performBatchThreading(self.correctMolFile, allFiles, self.numberOfThreads.get(), cloneItem=False)
+        with self.timeStage('correct'):
+            allFiles = []
+            for pocketDir in self.getPocketDirs():
+                # Poses of the chunks published while docking are already corrected
+                allFiles += [poseFile for _, poseFile in listPoseFiles(pocketDir) if isSplitPoseFile(poseFile)]
+            performBatchThreading(self.correctMolFile, allFiles, self.numberOfThreads.get(), cloneItem=False)
+
+        if self.crossDedup and not self.wholeProt:
+            with self.timeStage('dedup'):
+                self.removeCrossPocketDuplicates()
 
+        with self.timeStage('output'):
+            self.createOutputSet()
+        summarizeProfile(self.getProfileDir(), self._getExtraPath())
+        self.gatherQuarantine()
+
+    def createOutputSet(self):
         inputMolDic = self.getInputMolsDic()
-        outputSet = SetOfSmallMolecules().create(outputPath=self._getPath())
-        for pocketDir in self.getPocketDirs():
-            gridId = self.getGridId(pocketDir)
-            for file in os.listdir(pocketDir):
-                outDir = os.path.join(pocketDir, file)
-                if os.path.isdir(outDir):
-                    inMol = inputMolDic[file.split('.')[0]]
-                    for outFile in os.listdir(outDir):
-                        newSmallMol = SmallMolecule()
-                        newSmallMol.copy(inMol, copyId=False)
-
-                        molFile = os.path.join(outDir, outFile)
-                        newSmallMol._energy = pwobj.Float(self.parseEnergy(molFile))
-                        if os.path.getsize(molFile) > 0:
-                            newSmallMol.poseFile.set(molFile)
-                            newSmallMol.setPoseId(molFile.split('_')[-1].split('.')[0])
-                            newSmallMol.gridId.set(gridId)
-                            newSmallMol.setMolClass('LeDock')
-                            newSmallMol.setDockId(self.getObjId())
-                            outputSet.append(newSmallMol)
-
-        outputSet.proteinFile.set(self.getOriginalReceptorFile())
+        equivalentDic = self.getEquivalentKeysDic()
+        with _outputLock:
+            self._outputClosed = True
+            # An output set per receptor, so each one refers to the receptor its poses were docked on
+            if self.publishPartial:
+                # Completes the output sets published while docking with the poses not published yet
+                outputSets = {recId: self.loadStreamingSet(recId) for recId in self.getReceptorIds()}
+                publishedFiles = set(self.getPublishedPoseFiles())
+            else:
+                outputSets = {recId: self.createOutputMolSet(recId) for recId in self.getReceptorIds()}
+                publishedFiles = set()
+
+            bestDic, scoreRecords = {}, []
+            for pocketDir in self.getPocketDirs():
+                recId = self.getPocketDirReceptorId(pocketDir)
+                for dockKey, molFile in listPoseFiles(pocketDir):
+                    poseMols = self.getPoseMolecules(pocketDir, dockKey, molFile, inputMolDic, equivalentDic)
+                    for molKey, poseId, energy, newSmallMol in poseMols:
+                        if self.doEnsemble:
+                            gridId = self.getGridId(pocketDir)
+                            if molKey not in bestDic or energy < bestDic[molKey][0]:
+                                bestDic[molKey] = (energy, recId, gridId)
+                        if molFile not in publishedFiles:
+                            outputSets[recId].append(newSmallMol)
+                        scoreRecords.append((molKey, os.path.basename(pocketDir), poseId, energy, dockKey))
+
+            ScoreTable.fromRecords(scoreRecords).save(self.getScoreTableFile())
+            if self.doEnsemble:
+                self.writeEnsembleBestFile(bestDic)
+            if self.publishPartial:
+                for recId, outputSet in outputSets.items():
+                    self.updateStreamingSet(outputSet, recId, outputSet.STREAM_CLOSED)
+            else:
+                self._defineOutputs(**{self.getOutputName(recId): outputSet for recId, outputSet in outputSets.items()})
+
+    def getPoseMolecules(self, pocketDir, dockKey, molFile, inputMolDic, equivalentDic):
+        '''Returns the (molKey, poseId, energy, SmallMolecule) of the output molecules of a pose file: the poses of a
+        docked molecule are shared by all its equivalent input molecules'''
+        if os.path.getsize(molFile) == 0:
+            return []
+        energy = self.parseEnergy(molFile)
+        poseId = molFile.split('_')[-1].split('.')[0]
+        gridId = self.getGridId(pocketDir)
+        newMols = []
+        for molKey in equivalentDic.get(dockKey, [dockKey]):
+            newSmallMol = SmallMolecule()
+            newSmallMol.copy(inputMolDic[molKey], copyId=False)
+            newSmallMol._energy = pwobj.Float(energy)
+            newSmallMol.poseFile.set(molFile)
+            newSmallMol.setPoseId(poseId)
+            newSmallMol.gridId.set(gridId)
+            newSmallMol.setMolClass('LeDock')
+            newSmallMol.setDockId(self.getObjId())
+            newMols.append((molKey, poseId, float(energy), newSmallMol))
+        return newMols
+
+    def createOutputMolSet(self, recId=None):
+        if recId is None:
+            outputSet = SetOfSmallMolecules().create(outputPath=self._getPath())
+        else:
+            outputSet = SetOfSmallMolecules().create(outputPath=self._getPath(), suffix=recId)
+        self.setOutputSetProperties(outputSet, recId)
+        return outputSet
+
+    def setOutputSetProperties(self, outputSet, recId=None):
+        outputSet.proteinFile.set(self.getOriginalReceptorFile(recId))
         outputSet.setDocked(True)
-        self._defineOutputs(outputSmallMolecules=outputSet)
+
+    def getOutputName(self, recId=None):
+        '''Name of the output set with the poses docked on a receptor of the ensemble, or on the single receptor'''
+        return 'outputSmallMolecules' if recId is None else 'outputSmallMolecules_{}'.format(recId)
+
+    def _stepsCheck(self):
+        '''Called periodically while the steps run: publishes the poses of the chunks docked since the last update'''
+        if self.publishPartial and time.time() - getattr(self, '_lastPublish', 0) > self.publishPeriod.get() * 60:
+            self._lastPublish = time.time()
+            self.publishReadyPoses()
 
 ########################### Validation functions #######################
 
     def _validate(self):
         errors = []
+        if self.doEnsemble and not self.inputReceptors.get():
+            errors.append('You need to specify an input set of atom structures as receptor ensemble')
+
         if self.wholeProt:
-            if not self.inputAtomStruct.get():
+            if not self.doEnsemble and not self.inputAtomStruct.get():
                 errors.append('You need to specify an input atom structure')
             elif not self.radius.get():
                 errors.append('You need to specify a radius. You may use the wizard to do so')
@@ -180,8 +599,102 @@ class ProtChemLeDock(EMProtocol):
                 errors.append('You need to specify an input set of StructROIs')
             elif not self.pocketRadiusN.get():
                 errors.append('You need to specify a radius coefficient to adjust the StructROIs radius.')
+
+        if self.doFunnel and self.doStaged:
+            errors.append('Funnel and staged docking cannot be combined in the same run')
+        if self.pinCpus and not isAffinityAvailable():
+            errors.append('Pinning the docking jobs to CPUs is only available in Linux')
+        if self.dryRun and self.dryRunSample.get() < 2:
+            errors.append('At least 2 calibration ligands are needed to separate the ledock startup time')
+        if self.publishPartial and self.crossDedup and not self.wholeProt:
+            errors.append('Removing duplicate poses across ROIs needs all the poses, so it cannot be combined with '
+                          'publishing results while docking')
+        if self.getCompression() == 'zstd' and not isZstdAvailable():
+            errors.append('zstd compression needs the zstandard python package. Install it or use gzip')
         return errors
 
+    def _summary(self):
+        summary = []
+        if os.path.exists(self.getQuarantineFile()):
+            quarantined = readListFile(self.getQuarantineFile())
+            summary.append('{} ligand dockings exceeded the time limit and were quarantined: {}'.
+                           format(len(quarantined), ', '.join([line.replace('\t', ' in ') for line in quarantined])))
+
+        profileFile = self._getExtraPath('profile.json')
+        if os.path.exists(profileFile):
+            with open(profileFile) as f:
+                profile = json.load(f)
+            stages = sorted(profile['stages'].items(), key=lambda st: st[1]['start'])
+            summary.append('Stage times (s, summed over jobs): ' +
+                           ', '.join(['{} {:.1f}'.format(name, st['total']) for name, st in stages]))
+            if profile['slowestLigands']:
+                summary.append('Mean ligand docking time: {:.2f} s. Slowest ligands: {}'.format(
+                    profile['meanLigandTime'],
+                    ', '.join(['{} ({}) {:.1f} s'.format(*rec[:2], rec[3]) for rec in profile['slowestLigands'][:5]])))
+            summary.append('Full profile in {}'.format(self._getExtraPath('profile_ligands.csv')))
+
+        if self.dryRun and os.path.exists(self.getPlanFile()):
+            with open(self.getPlanFile()) as f:
+                summary += self.getPlanSummary(json.load(f))
+
+        if os.path.exists(self.getProgressFile()):
+            with open(self.getProgressFile()) as f:
+                progress = json.load(f)
+            summary.append('Docking progress at {}: '.format(time.strftime('%Y-%m-%d %H:%M',
+                                                                          time.localtime(progress['time']))) +
+                           '; '.join(['{} {}/{} ligands, {:.1f} ligands/h, time left {}'.format(
+                               pocketName, info['done'], info['total'], info['rate'], formatDuration(info['eta']))
+                               for pocketName, info in sorted(progress['pockets'].items())]))
+
+        if os.path.exists(self.getScoreTableFile()):
+            best = self.getScoreTable().topN(3)
+            summary.append('Best poses: {}. Score table in {}'.format(
+                ', '.join(['{} ({} pose {}) {:.2f}'.format(*rec) for rec in best]), self.getScoreTableFile()))
+
+        if self.autoChunk and os.path.exists(self.getProfileDir()):
+            chunkSizes = {}
+            for file in sorted(os.listdir(self.getProfileDir())):
+                if file.startswith('chunks_'):
+                    with open(os.path.join(self.getProfileDir(), file)) as f:
+                        chunkSizes[os.path.splitext(file)[0][len('chunks_'):]] = json.load(f)['chunkSize']
+            if chunkSizes:
+                summary.append('Auto tuned chunk sizes: ' +
+                               ', '.join(['{} {}'.format(jobKey, size) for jobKey, size in chunkSizes.items()]))
+
+        if self.crossDedup and os.path.exists(self.getCrossDuplicatesFile()):
+            summary.append('{} duplicate poses across ROIs removed (listed in {})'.format(
+                len(readListFile(self.getCrossDuplicatesFile())), self.getCrossDuplicatesFile()))
+
+        if self.doDedup and os.path.exists(self.getDuplicatesFile()):
+            groups = readClustersFile(self.getDuplicatesFile())
+            nInput = sum([len(members) for members in groups])
+            summary.append('{} unique molecules docked out of {} input molecules'.format(len(groups), nInput))
+
+        if self.doFunnel or self.doStaged:
+            for recId, pocket in self.getTargets():
+                if os.path.exists(self.getStageInfoFile(pocket, recId)):
+                    with open(self.getStageInfoFile(pocket, recId)) as f:
+                        info = json.load(f)
+                    pocketName = os.path.basename(self.getOutputPocketDir(pocket, recId))
+                    if self.doFunnel:
+                        summary.append('Funnel docking in {}: {} of {} clusters expanded, {} of {} ligands docked'.
+                                       format(pocketName, info['nExpanded'], info['nClusters'], info['nDocked'],
+                                              info['nLigands']))
+                    else:
+                        summary.append('Staged docking in {}: {} of {} ligands refined'.
+                                       format(pocketName, info['nRefined'], info['nLigands']))
+
+        if self.doEnsemble and os.path.exists(self.getEnsembleBestFile()):
+            recCounts = {}
+            for line in readListFile(self.getEnsembleBestFile())[1:]:
+                recId = line.split('\t')[2]
+                recCounts[recId] = recCounts.get(recId, 0) + 1
+            summary.append('Best scores per ligand across the ensemble in {}. Best receptor counts: {}'.
+                           format(self.getEnsembleBestFile(), ', '.join(['{}: {}'.format(recId, n) for
+                                                                         recId, n in sorted(recCounts.items())])))
+            summary.append('The poses docked on each receptor are in outputSmallMolecules_<receptor id>')
+        return summary
+
     def _citations(self):
         return ['C6CP01555G']
       
@@ -190,50 +703,122 @@ class ProtChemLeDock(EMProtocol):
     def convertAndWriteMolSet(self, molSet, outDir, nJobs):
         convMolFiles = runInParallel(obabelMolConversion, '.mol2', outDir, paramList=[item.clone() for item in molSet],
                                      jobs=nJobs)
-        molFileSubsets = makeSubsets(convMolFiles, self.getnThreads(), cloneItem=False)
-
-        with open(self.getLigandListFile(), 'w') as fLig:
-            for iSet, molFSet in enumerate(molFileSubsets):
-                with open(self.getLigandListFile(base=True, idx=iSet), 'w') as fLigBase:
-                    for molFile in molFSet:
-                        fLig.write(molFile + '\n')
-                        fLigBase.write(os.path.basename(molFile) + '\n')
-
-    def performSplit(self, dockFiles, molLists, it, outDir):
-        for dockFile in dockFiles:
-            dockBase = os.path.basename(dockFile)
-            dockRoot = dockBase.split('.')[0]
-            dockDir = os.path.join(outDir, dockRoot)
-            os.mkdir(dockDir)
-
-            newDockFile = os.path.join(dockDir, dockBase)
-            os.rename(dockFile, newDockFile)
-            args = ' -spli ' + os.path.abspath(newDockFile)
-            lephar_plugin.runLePhar(self, program=self._program, args=args, cwd=outDir, runJob=False)
-            os.remove(newDockFile)
+        if self.doDedup:
+            duplicates = self.groupDuplicates(convMolFiles)
+            writeClustersFile(self.getDuplicatesFile(), duplicates)
+            convMolFiles = [members[0] for members in duplicates]
+
+        writeListFile(self.getLigandListFile(), convMolFiles)
+        if self.costOrder:
+            prevTimes = readLigandTimes(self.costProfile.get()) if self.costProfile.get() else None
+            writeCostsFile(self.getCostsFile(), convMolFiles, getLigandCosts(convMolFiles, prevTimes))
+
+        if self.doFunnel:
+            # Only the cluster representatives are docked in the first stage
+            clusters = clusterMolFiles(convMolFiles, self.funnelCut.get())
+            writeClustersFile(self.getClustersFile(), clusters)
+            convMolFiles = [members[0] for members in clusters]
+        self.writeLigandSubsets(convMolFiles, self.getnThreads())
+
+        if self.packLibrary:
+            # Costs and clusters already computed from the single files
+            packMolLibrary(readListFile(self.getLigandListFile()), self.getLibraryFile(), self.getLibraryIndexFile())
+
+    def writeLigandSubsets(self, molFiles, nThreads, pocket=None, stage=1, recId=None):
+        '''Writes the ligand lists (basenames) for each of the docking jobs of a stage'''
+        if self.costOrder:
+            costsDic = readCostsFile(self.getCostsFile())
+            molFileSubsets = packLongestFirst(molFiles, [costsDic[molFile] for molFile in molFiles], nThreads)
+        else:
+            molFileSubsets = makeSubsets(molFiles, nThreads, cloneItem=False) if molFiles else []
+        molFileSubsets += [[]] * (nThreads - len(molFileSubsets))
+        for iSet, molFSet in enumerate(molFileSubsets):
+            publishListFile(self.getLigandListFile(base=True, idx=iSet, pocket=pocket, stage=stage, recId=recId),
+                            [os.path.basename(molFile) for molFile in molFSet])
+
+    def runDockWatched(self, pocket, idx, stage, recId, ligFiles, workDir, cpus=None):
+        '''Runs ledock on a list of ligands with a time limit per ligand. When a ligand exceeds it, the execution is
+        killed, the ligand quarantined and ledock run again with the remaining ligands'''
+        oDir = self.getOutputPocketDir(pocket, recId)
+        jobName = self.getJobName(idx, stage)
+        dockParamFile = os.path.join(workDir, 'dock_{}.in'.format(jobName))
+        remaining, nRetry = ligFiles, 0
+        while remaining:
+            dokFiles = [os.path.join(workDir, getLigandKey(ligFile) + '.dok') for ligFile in remaining]
+            cmd = [lephar_plugin.getLePharProgram(self._program), dockParamFile]
+            retCode, nProcessed = runLeDockWatched(cmd, dokFiles, self.ligTimeout.get() * 60, cwd=workDir,
+                                                   env=lephar_plugin.getEnviron(),
+                                                   logFile=os.path.join(workDir, 'dock_{}.log'.format(jobName)),
+                                                   cpus=cpus)
+            if retCode is not None:
+                if retCode != 0:
+                    raise Exception('ledock failed with code {} in {}'.format(retCode, dockParamFile))
+                break
+
+            with open(self.getPocketQuarantineFile(pocket, recId), 'a') as f:
+                f.write('{}\n'.format(remaining[nProcessed]))
+            print('Ligand {} exceeded the time limit in {} and was quarantined'.format(remaining[nProcessed], oDir))
+
+            # Restart with the ligands after the quarantined one
+            remaining, nRetry = remaining[nProcessed + 1:], nRetry + 1
+            retryList = writeListFile(os.path.join(workDir, 'ligandsBase_{}_retry{}.list'.format(jobName, nRetry)),
+                                      remaining)
+            dockParamFile, _ = self.writeDockInFile(pocket, idx, stage, recId, ligList=retryList, workDir=workDir)
+
+    def gatherQuarantine(self):
+        quarantined = []
+        for pocketDir in self.getPocketDirs():
+            qFile = os.path.join(pocketDir, 'quarantine.txt')
+            if os.path.exists(qFile):
+                quarantined += ['{}\t{}'.format(lig, os.path.basename(pocketDir)) for lig in readListFile(qFile)]
+        if quarantined:
+            writeListFile(self.getQuarantineFile(), quarantined)
+
+    def prepareDockReceptors(self):
+        '''Prepares the receptors with lepro and, if chosen, crops them around each pocket'''
+        with self.timeStage('receptor'):
+            if not self.doEnsemble:
+                lephar_plugin.runLePhar(self, 'lepro', args=os.path.abspath(self.getOriginalReceptorFile()),
+                                        cwd=self._getExtraPath())
+            else:
+                self.prepareReceptors(self.getReceptorIds())
+
+        if self.cropReceptor and not self.wholeProt:
+            with self.timeStage('crop'):
+                for recId, pocket in self.getTargets():
+                    center, radius = self.getPocketBox(pocket, recId)
+                    cropReceptor(self.getPreparedReceptorFile(recId), self.getDockReceptorFile(pocket, recId),
+                                 center, radius, self.cropMargin.get())
+
+    def prepareReceptors(self, recIds):
+        recDirs = [self.getReceptorDir(recId) for recId in recIds]
+        for recDir in recDirs:
+            os.makedirs(recDir, exist_ok=True)
+        lephar_plugin.runLePharJobs('lepro', [[os.path.abspath(self.getOriginalReceptorFile(recId))]
+                                              for recId in recIds], recDirs, maxJobs=self.numberOfThreads.get())
+
+    def writeEnsembleBestFile(self, bestDic):
+        with open(self.getEnsembleBestFile(), 'w') as f:
+            f.write('ligand\tenergy\treceptorId\tgridId\n')
+            for molKey in sorted(bestDic, key=lambda k: bestDic[k][0]):
+                f.write('{}\t{}\t{}\t{}\n'.format(molKey, *bestDic[molKey]))
 
     def correctMolFile(self, molFiles, molsLists, it):
+        compression = self.getCompression() if self.compressPoses else None
         for molFile in molFiles:
-            newFile = self.renameDockFile(molFile)
-            with open(molFile) as fIn:
-                with open(newFile, 'w') as f:
-                    for line in fIn:
-                        if line.startswith('ATOM'):
-                            atomSym = removeNumberFromStr(line.split()[2])
-                            line = line.strip() + '  1.00  0.00{}{}\n'.format(' ' * (12 - len(atomSym)), atomSym)
-                        f.write(line)
+            addPDBColumns(molFile, self.renameDockFile(molFile, compression))
             os.remove(molFile)
 
     def getDockFiles(self, pocketDir):
         dockFiles = []
         for file in os.listdir(pocketDir):
-            if file.endswith('.dok'):
+            if isDockFile(file):
                 dockFiles.append(os.path.abspath(os.path.join(pocketDir, file)))
         return dockFiles
 
     def getnThreads(self):
         '''Get the number of threads available for each pocket execution'''
-        nThreads = self.numberOfThreads.get()
+        nThreads = self.numberOfThreads.get() // len(self.getReceptorIds())
         if not self.wholeProt:
             nPockets = len(self.inputStructROIs.get())
             nThreads = nThreads // nPockets
@@ -241,10 +826,7 @@ class ProtChemLeDock(EMProtocol):
         return nThreads
 
     def parseEnergy(self, molFile):
-        with open(molFile) as fMol:
-            fMol.readline()
-            line = fMol.readline()
-        return line.split()[-2]
+        return parsePoseEnergy(molFile)
 
 
     def getInputMolsDic(self):
@@ -253,12 +835,8 @@ class ProtChemLeDock(EMProtocol):
             dic[mol.clone().getUniqueName(False, True, False, False)] = mol.clone()
         return dic
 
-    def renameDockFile(self, outFile):
-        outBase = os.path.basename(outFile)
-        newBase = '{}{}.pdb'.format(outBase.split('dock')[0],
-                                    int(outBase.split('dock')[-1].split('.')[0]))
-        newFile = os.path.join(os.path.dirname(outFile), newBase)
-        return newFile
+    def renameDockFile(self, outFile, compression=None):
+        return getPoseFileName(outFile, compression)
 
     def getGridId(self, outDir):
         return outDir.split('_')[-1]
@@ -272,67 +850,383 @@ class ProtChemLeDock(EMProtocol):
         dirs.sort()
         return dirs
 
-    def getOutputPocketDir(self, pocket=None):
+    def getPockets(self):
+        if self.wholeProt:
+            return [None]
+        return [pocket.clone() for pocket in self.inputStructROIs.get()]
+
+    def getReceptorIds(self):
+        if not self.doEnsemble:
+            return [None]
+        return [receptor.getObjId() for receptor in self.inputReceptors.get()]
+
+    def getTargets(self):
+        '''Returns the (receptorId, pocket) combinations where the ligands are docked'''
+        return [(recId, pocket) for recId in self.getReceptorIds() for pocket in self.getPockets()]
+
+    def getOutputPocketDir(self, pocket=None, recId=None):
         if pocket==None:
-            outDir = self._getExtraPath('pocket_1')
+            pocketName = 'pocket_1'
         else:
-            outDir = self._getExtraPath('pocket_{}'.format(pocket.getObjId()))
-        return outDir
+            pocketName = 'pocket_{}'.format(pocket.getObjId())
 
-    def getOriginalReceptorFile(self):
-        if self.wholeProt:
+        if recId is not None:
+            pocketName = 'rec{}_{}'.format(recId, pocketName)
+        return self._getExtraPath(pocketName)
+
+    def getPocketDirReceptorId(self, pocketDir):
+        pocketName = os.path.basename(pocketDir)
+        if pocketName.startswith('rec'):
+            return int(pocketName.split('_')[0][3:])
+
+    def getOriginalReceptorFile(self, recId=None):
+        if recId is not None:
+            return self.inputReceptors.get()[recId].getFileName()
+        elif self.wholeProt:
             return self.inputAtomStruct.get().getFileName()
         else:
             return self.inputStructROIs.get().getProteinFile()
 
-    def getPreparedReceptorFile(self):
-        return self._getExtraPath('pro.pdb')
+    def getReceptorDir(self, recId=None):
+        if recId is None:
+            return self._getExtraPath()
+        return self._getExtraPath('receptor_{}'.format(recId))
+
+    def getPreparedReceptorFile(self, recId=None):
+        return os.path.join(self.getReceptorDir(recId), 'pro.pdb')
+
+    def getQuarantineFile(self):
+        return self._getExtraPath('quarantine.tsv')
+
+    def getPocketQuarantineFile(self, pocket=None, recId=None):
+        return os.path.join(self.getOutputPocketDir(pocket, recId), 'quarantine.txt')
 
-    def getLigandListFile(self, base=False, idx=None):
+    def getProfileDir(self):
+        return self._getExtraPath('profile')
+
+    def timeStage(self, stage, key='main'):
+        return timeStage(self.getProfileDir(), stage, key)
+
+    def getEnsembleBestFile(self):
+        return self._getExtraPath('ensembleBest.tsv')
+
+    def getLigandListFile(self, base=False, idx=None, pocket=None, stage=1, recId=None):
         if not base:
             return os.path.abspath(self._getPath('ligands.list'))
-        else:
+        elif stage == 1:
             return os.path.abspath(self._getPath('ligandsBase_{}.list'.format(idx)))
-            
+        else:
+            # Later stages ligand lists depend on each pocket results
+            return os.path.abspath(os.path.join(self.getOutputPocketDir(pocket, recId),
+                                                'ligandsBase_{}_{}.list'.format(stage, idx)))
+
+    def getJobName(self, idx, stage=1):
+        return '{}'.format(idx) if stage == 1 else '{}_{}'.format(stage, idx)
+
+    def removeCrossPocketDuplicates(self):
+        '''Removes the poses of a ligand closer than rmsTol to a better scored pose of the same ligand in any pocket
+        of the same receptor'''
+        ligPoses = {}
+        for pocketDir in self.getPocketDirs():
+            recId = self.getPocketDirReceptorId(pocketDir)
+            for molKey, poseFile in listPoseFiles(pocketDir):
+                ligPoses.setdefault((recId, molKey), []).append(poseFile)
+
+        removed = []
+        for (recId, molKey), poseFiles in ligPoses.items():
+            # Poses grouped by number of atoms, so they can be stacked (they all should match)
+            allCoords = [readPoseCoords(poseFile) for poseFile in poseFiles]
+            for poseGroup in groupByKey(list(zip(poseFiles, allCoords)), [len(coords) for coords in allCoords]):
+                if len(poseGroup) > 1:
+                    coords = np.stack([coords for _, coords in poseGroup])
+                    energies = [float(self.parseEnergy(poseFile)) for poseFile, _ in poseGroup]
+                    kept = set(selectDistinctPoses(coords, energies, self.rmsTol.get()))
+                    removed += [(molKey, poseFile) for i, (poseFile, _) in enumerate(poseGroup) if i not in kept]
+
+        for _, poseFile in removed:
+            os.remove(poseFile)
+        writeListFile(self.getCrossDuplicatesFile(), ['{}\t{}'.format(*rec) for rec in removed])
+
+    def getScoreTableFile(self):
+        return os.path.abspath(self._getExtraPath('scores.npz'))
+
+    def getScoreTable(self):
+        '''Returns the lephar.scoring.ScoreTable with the (ligand, pocket, pose) energies of the output, to rank them
+        without reading the output set'''
+        return ScoreTable.load(self.getScoreTableFile())
+
+    def getPoseFile(self, scoreTable, ligand, pocket, poseId):
+        '''Returns the pose file of a (ligand, pocket, poseId) of the score table, None if not found'''
+        dockKey = scoreTable.getDockKey(ligand)
+        poseFile = self._getExtraPath(pocket, dockKey, '{}_{}.pdb'.format(dockKey, poseId))
+        for ext in [''] + list(COMPRESSION_EXTS.values()):
+            if os.path.exists(poseFile + ext):
+                return os.path.abspath(poseFile + ext)
+
+    def getCrossDuplicatesFile(self):
+        return self._getExtraPath('crossPocketDuplicates.tsv')
+
+    def getDuplicatesFile(self):
+        return os.path.abspath(self._getExtraPath('duplicates.tsv'))
+
+    def getEquivalentKeysDic(self):
+        '''Returns {docked ligand key: [keys of the equivalent input ligands]} for the collapsed duplicates'''
+        if not self.doDedup:
+            return {}
+        return {getLigandKey(members[0]): [getLigandKey(molFile) for molFile in members]
+                for members in readClustersFile(self.getDuplicatesFile())}
+
+    def groupDuplicates(self, molFiles):
+        '''Groups the molecule files with the same InChIKey, computed by obabel in parallel'''
+        keys = dict(performBatchThreading(self.inchiKeyTask, molFiles, self.numberOfThreads.get(), cloneItem=False))
+        # Molecules without key (obabel failure) are kept as unique
+        return groupByKey(molFiles, [keys.get(molFile) or molFile for molFile in molFiles])
 
-    def writeDockInFile(self, pocket, idx):
-        pDir = self.getOutputPocketDir(pocket)
+    def inchiKeyTask(self, molFiles, keysLists, it):
+        '''Computes the InChIKeys of a subset of molecule files with an obabel call per INCHIKEY_BATCH files. Each
+        output line has the key followed by the molecule title, which ends with its file name (--addfilename), so
+        the keys are mapped back to the files even if obabel fails with some of them'''
+        for iBatch in range(0, len(molFiles), INCHIKEY_BATCH):
+            batch = molFiles[iBatch:iBatch + INCHIKEY_BATCH]
+            keyFile = os.path.abspath(self._getExtraPath('inchikeys_{}_{}.txt'.format(it, iBatch)))
+            runOpenBabel(protocol=self, args=' -imol2 {} -oinchikey -xt --addfilename -O {}'.
+                         format(' '.join([os.path.abspath(molFile) for molFile in batch]), keyFile),
+                         cwd=self._getExtraPath())
+            batchKeys = {}
+            if os.path.exists(keyFile):
+                for line in readListFile(keyFile):
+                    fields = line.split()
+                    if len(fields) > 1:
+                        batchKeys[fields[-1]] = fields[0]
+                os.remove(keyFile)
+            keysLists[it] += [(molFile, batchKeys.get(os.path.basename(molFile))) for molFile in batch]
+
+    def getLibraryFile(self):
+        return os.path.abspath(self._getExtraPath('ligandsLibrary.mol2'))
+
+    def getLibraryIndexFile(self):
+        return os.path.abspath(self._getExtraPath('ligandsLibrary.idx'))
+
+    def getCompression(self):
+        '''Returns the compression format of the docking files or None'''
+        return COMPRESSION_CHOICES[self.compression.get()] if self.compression.get() else None
+
+    def writeChunkList(self, pocketDir, stage, idx, iChunk, ligFiles, claim=False):
+        chunkList = os.path.abspath(os.path.join(pocketDir, 'chunk_{}_{}_{}.list'.format(stage, idx, iChunk)))
+        if claim:
+            claimFile(chunkList)
+        return publishListFile(chunkList, ligFiles)
+
+    def getPendingChunks(self, pocketDir, stage, idx):
+        '''Returns the chunk lists of a docking job, followed (with auto chunking) by the ones of the other jobs of
+        the pocket and stage, last chunks first, excluding the already claimed ones'''
+        jobChunks = {}
+        for file in os.listdir(pocketDir):
+            if file.startswith('chunk_{}_'.format(stage)) and file.endswith('.list'):
+                _, _, jobIdx, iChunk = os.path.splitext(file)[0].split('_')
+                chunkList = os.path.abspath(os.path.join(pocketDir, file))
+                jobChunks.setdefault(int(jobIdx), []).append((int(iChunk), chunkList))
+
+        chunks = [chunkList for _, chunkList in sorted(jobChunks.pop(idx, []))]
+        if self.autoChunk:
+            for jobIdx in sorted(jobChunks):
+                chunks += [chunkList for _, chunkList in sorted(jobChunks[jobIdx], reverse=True)]
+        return [chunkList for chunkList in chunks if not os.path.exists(chunkList + '.claim')]
+
+    def isFinalStage(self, stage):
+        '''Whether the poses docked in a stage are final results. The poses of the funnel representatives are, but
+        their .dok files are needed to select the clusters to expand'''
+        return stage == 2 or not (self.doFunnel or self.doStaged)
+
+    def splitChunk(self, pocketDir, chunkKey, dokFiles):
+        '''Splits and corrects the poses of a docked chunk and lists them in a ready file for publication'''
+        dokFiles = [moveToSplitDir(dokFile, pocketDir) for dokFile in dokFiles if os.path.exists(dokFile)]
+        lephar_plugin.runLePharJobs(self._program, [['-spli', dokFile] for dokFile in dokFiles],
+                                    [pocketDir] * len(dokFiles))
+        poses = []
+        for dokFile in dokFiles:
+            os.remove(dokFile)
+            dockKey, splitDir = getLigandKey(dokFile), os.path.dirname(dokFile)
+            splitFiles = [os.path.join(splitDir, file) for file in os.listdir(splitDir)]
+            self.correctMolFile(splitFiles, None, None)
+            poses += ['{}\t{}'.format(dockKey, os.path.join(splitDir, file)) for file in sorted(os.listdir(splitDir))]
+        publishListFile(os.path.join(pocketDir, 'ready_{}.list'.format(chunkKey)), poses)
+
+    def getPublishedPoseFiles(self):
+        poseFiles = []
+        for pocketDir in self.getPocketDirs():
+            for file in os.listdir(pocketDir):
+                if file.startswith('ready_') and file.endswith('.published'):
+                    poseFiles += [line.split('\t')[1] for line in readListFile(os.path.join(pocketDir, file))]
+        return poseFiles
+
+    def publishReadyPoses(self):
+        '''Adds the poses of the chunks split since the last publication to the output set'''
+        with _outputLock:
+            readyFiles = []
+            for pocketDir in self.getPocketDirs():
+                readyFiles += [os.path.join(pocketDir, file) for file in os.listdir(pocketDir)
+                               if file.startswith('ready_') and file.endswith('.list')]
+            if getattr(self, '_outputClosed', False) or not readyFiles:
+                return
+
+            inputMolDic = self.getInputMolsDic()
+            equivalentDic = self.getEquivalentKeysDic()
+            outputSets = {}
+            for readyFile in readyFiles:
+                pocketDir = os.path.dirname(readyFile)
+                recId = self.getPocketDirReceptorId(pocketDir)
+                if recId not in outputSets:
+                    outputSets[recId] = self.loadStreamingSet(recId)
+                for line in readListFile(readyFile):
+                    dockKey, molFile = line.split('\t')
+                    for _, _, _, newSmallMol in self.getPoseMolecules(pocketDir, dockKey, molFile, inputMolDic,
+                                                                      equivalentDic):
+                        outputSets[recId].append(newSmallMol)
+            for recId, outputSet in outputSets.items():
+                self.updateStreamingSet(outputSet, recId)
+            for readyFile in readyFiles:
+                os.rename(readyFile, readyFile + '.published')
+
+    def loadStreamingSet(self, recId=None):
+        '''Opens the output set of a receptor published while docking, creating it the first time'''
+        setFile = self._getPath('{}.sqlite'.format(self.getOutputName(recId)))
+        outputSet = SetOfSmallMolecules(filename=setFile)
+        if os.path.exists(setFile):
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+        else:
+            self.setOutputSetProperties(outputSet, recId)
+            outputSet.setStreamState(outputSet.STREAM_OPEN)
+        return outputSet
+
+    def updateStreamingSet(self, outputSet, recId=None, state=None):
+        outputName = self.getOutputName(recId)
+        outputSet.setStreamState(outputSet.STREAM_OPEN if state is None else state)
+        if self.hasAttribute(outputName):
+            outputSet.write()
+            outputAttr = getattr(self, outputName)
+            outputAttr.copy(outputSet)
+            self._store(outputAttr)
+        else:
+            self._defineOutputs(**{outputName: outputSet})
+            self._store(outputSet)
+        outputSet.close()
+
+    def getPlanFile(self):
+        return self._getExtraPath('plan.json')
+
+    def getStagesPlan(self, nLigands, overhead, perLigand):
+        '''Returns the plan of the docking stages of a pocket, from the times measured with the first stage runs.
+        Funnel docking is planned as if all the ligands were docked (upper bound) and the second stage of staged
+        docking scaled by its number of runs'''
+        nJobs, autoChunk = self.getnThreads(), self.autoChunk.get()
+        stages = [planDockJobs(nLigands, nJobs, self.getStageRuns(1), overhead, perLigand, autoChunk)]
+        if self.doStaged:
+            nRefined = int(math.ceil(nLigands * self.fineTopPerc.get() / 100))
+            fineTime = perLigand * self.nRuns.get() / max(self.coarseRuns.get(), 1)
+            stages.append(planDockJobs(nRefined, nJobs, self.nRuns.get(), overhead, fineTime, autoChunk))
+        return stages
+
+    def getPlanSummary(self, plan):
+        lines = ['Dry run plan of {} ligands in {} pockets: {} docking jobs, {} ledock invocations, up to {} files. '
+                 'Estimated {:.1f} CPU hours ({:.1f} h with {} threads), from {} ligands docked in each pocket'.
+                 format(plan['nLigands'], len(plan['targets']), plan['jobs'], plan['invocations'], plan['files'],
+                        plan['cpuSeconds'] / 3600, plan['wallSeconds'] / 3600, plan['threads'], plan['sample'])]
+        lines += ['  {}: box {:.0f} A^3, ledock startup {:.2f} s, {:.2f} s per ligand, {:.1f} CPU hours'.
+                  format(name, target['boxVolume'], target['overhead'], target['perLigand'],
+                         target['cpuSeconds'] / 3600) for name, target in sorted(plan['targets'].items())]
+        return lines
+
+    def getCpuSlots(self):
+        '''Returns the pool of CPU sets of the concurrent docking jobs (empty if they are not pinned)'''
+        with _progressLock:
+            if getattr(self, '_cpuSlots', None) is None:
+                self._cpuSlots = CpuSlots(self.numberOfThreads.get() if self.pinCpus else 0)
+            return self._cpuSlots
+
+    def getProgressFile(self):
+        return self._getExtraPath('progress.json')
+
+    def getDockProgress(self):
+        '''Returns the docking progress monitor of this execution, started by the first chunk docked'''
+        with _progressLock:
+            if getattr(self, '_dockProgress', None) is None:
+                listFiles, cache = self.getPocketListFiles(), {}
+                self._dockProgress = DockProgress(self.getProgressFile(), lambda: countListsLigands(listFiles, cache),
+                                                  doneCounts=countProfileLigands(self.getProfileDir()))
+                self._dockProgress.start()
+            return self._dockProgress
+
+    def stopDockProgress(self):
+        with _progressLock:
+            if getattr(self, '_dockProgress', None) is not None:
+                self._dockProgress.stop()
+
+    def getPocketListFiles(self):
+        '''Returns the ligand list files of the docking jobs of each pocket, including the ones of the second stage
+        that are not written yet'''
+        listFiles = {}
+        for recId, pocket in self.getTargets():
+            pocketName = os.path.basename(self.getOutputPocketDir(pocket, recId))
+            for stage in [1, 2] if self.doFunnel or self.doStaged else [1]:
+                listFiles.setdefault(pocketName, []).extend(
+                    [self.getLigandListFile(base=True, idx=idx, pocket=pocket, stage=stage, recId=recId)
+                     for idx in range(self.getnThreads())])
+        return listFiles
+
+    def getCostsFile(self):
+        return os.path.abspath(self._getExtraPath('ligandCosts.tsv'))
+
+    def getClustersFile(self):
+        return os.path.abspath(self._getExtraPath('clusters.tsv'))
+
+    def getStageInfoFile(self, pocket=None, recId=None):
+        return os.path.join(self.getOutputPocketDir(pocket, recId), 'stages.json')
+
+    def getStageRuns(self, stage=1):
+        '''Number of poses per ligand in each docking stage'''
+        if self.doStaged and stage == 1:
+            return self.coarseRuns.get()
+        return self.nRuns.get()
+
+    def getPocketBox(self, pocket, recId=None):
+        '''Returns the center and radius (half side) of the docking box of a pocket'''
         if not self.wholeProt:
             x_center, y_center, z_center = pocket.calculateMassCenter()
             r = pocket.getDiameter() / 2
         else:
-            ASH = AtomicStructHandler(self.getPreparedReceptorFile())
+            ASH = AtomicStructHandler(self.getPreparedReceptorFile(recId))
             x_center, y_center, z_center = ASH.centerOfMass()
             r = self.radius.get()
+        return (x_center, y_center, z_center), r
 
-        xmin, xmax = x_center - r, x_center + r
-        ymin, ymax = y_center - r, y_center + r
-        zmin, zmax = z_center - r, z_center + r
+    def getDockReceptorFile(self, pocket, recId=None):
+        '''Returns the receptor file docked in a pocket: the prepared receptor or its crop around the pocket'''
+        if self.cropReceptor and not self.wholeProt:
+            return os.path.abspath(os.path.join(self.getOutputPocketDir(pocket, recId), 'pro_crop.pdb'))
+        return os.path.abspath(self.getPreparedReceptorFile(recId))
 
-        localReceptor = self.linkLocal(os.path.abspath(self.getPreparedReceptorFile()), pDir)
-        localLigList = self.doLocalLig(pDir, idx)
+    def writeDockInFile(self, pocket, idx, stage=1, recId=None, ligList=None, workDir=None):
+        pDir = workDir if workDir else self.getOutputPocketDir(pocket, recId)
+        center, r = self.getPocketBox(pocket, recId)
 
-        strIn = DOCK_IN.format(localReceptor, self.rmsTol.get(), xmin, xmax, ymin, ymax, zmin, zmax,
-                               self.nRuns.get(), localLigList)
-
-        dockFile = os.path.abspath(os.path.join(pDir, 'dock_{}.in'.format(idx)))
-        with open(dockFile, 'w') as fIn:
-            fIn.write(strIn)
+        localReceptor = self.linkLocal(self.getDockReceptorFile(pocket, recId), pDir)
+        if not ligList:
+            ligList = self.getLigandListFile(base=True, idx=idx, pocket=pocket, stage=stage, recId=recId)
+        localLigList = self.linkLocal(ligList, pDir)
 
+        dockFile = os.path.abspath(os.path.join(pDir, 'dock_{}.in'.format(self.getJobName(idx, stage))))
+        writeDockInput(dockFile, localReceptor, self.rmsTol.get(), getDockBox(center, r),
+                       self.getStageRuns(stage), localLigList)
         return dockFile, localLigList
 
     def linkLocal(self, sourcePath, outDir):
-        outFile = os.path.join(outDir, os.path.basename(sourcePath))
-        if not os.path.exists(outFile):
-            os.symlink(sourcePath, outFile)
-        return os.path.basename(sourcePath)
-
-    def doLocalLig(self, outDir, idx=0):
-        if idx == 0:
-            with open(self.getLigandListFile()) as fIn:
-                for molFile in fIn:
-                    self.linkLocal(molFile.strip(), outDir)
-
-        return self.linkLocal(self.getLigandListFile(base=True, idx=idx), outDir)
+        return linkLocal(sourcePath, outDir)
+
+    def doLocalLig(self, outDir):
+        '''Links all the converted ligand files into a docking directory'''
+        for molFile in readListFile(self.getLigandListFile()):
+            self.linkLocal(molFile, outDir)
 
 
@@ -25,15 +25,31 @@
 # **************************************************************************
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 from pwem.protocols import EMProtocol
-from pwem.objects import AtomStruct
+from pwem.objects import AtomStruct, SetOfAtomStructs
 from pyworkflow.protocol.params import PointerParam, BooleanParam, StringParam
 
-from pwchem.utils import cleanPDB, removeNumberFromStr, getChainIds
 from pwchem.protocols import ProtChemPrepareReceptor
+from pwchem.utils import cleanPDB, getChainIds
 
 from lephar import Plugin as lephar_plugin
+from lephar.utils import addPDBColumns, runCommands, readListFile, writeListFile
+
+
+def prepareStructureTask(pdbFile, cleanFile, outFile, hetatm, chainIds, leproCmd, env):
+    '''Prepares a structure in the directory of outFile: cleans it, runs lepro and completes the PDB columns of its
+    output. Runs in a worker process, so it only takes picklable arguments.
+    Returns None if it succeeded or the error output otherwise'''
+    outDir = os.path.dirname(outFile)
+    cleanFile = cleanPDB(pdbFile, cleanFile, False, hetatm, chainIds)
+    result = runCommands([([leproCmd, os.path.abspath(cleanFile)], outDir)], env=env, check=False)[0]
+    proFile = os.path.join(outDir, 'pro.pdb')
+    if result.returncode != 0 or not os.path.exists(proFile):
+        return result.stderr or 'lepro did not write pro.pdb'
+    os.rename(proFile, outFile)
+    addPDBColumns(outFile, rightAlign=False)
 
 
 class ProtChemLePro(ProtChemPrepareReceptor):
@@ -46,53 +62,112 @@ class ProtChemLePro(ProtChemPrepareReceptor):
     def _defineParams(self, form):
         form.addSection(label='Input')
         group = form.addGroup('Input')
-        group.addParam('inputAtomStruct', PointerParam, pointerClass="AtomStruct",
+        group.addParam('inputAtomStruct', PointerParam, pointerClass="AtomStruct, SetOfAtomStructs",
                        label='Input atomic structure:',
-                       help="The atom structure to be prepared")
+                       help="The atom structure to be prepared. If a set of atomic structures is provided, "
+                            "each of them will be prepared in parallel (e.g. for ensemble docking)")
 
         clean = self.defineCleanParams(form, w=False, hk=False)
 
+        form.addParallelSection(threads=4, mpi=1)
+
     # --------------------------- INSERT steps functions --------------------
     def _insertAllSteps(self):
         self._insertFunctionStep('preparationStep')
         self._insertFunctionStep('createOutputStep')
 
     def preparationStep(self):
-        # Clean PDB
-        pdb_ini = self.inputAtomStruct.get().getFileName()
-        filename = os.path.splitext(os.path.basename(pdb_ini))[0]
-        fnPdb = self._getExtraPath('%s_clean.pdb' % filename)
-
-        chain_ids = None
-        if self.rchains.get():
-            chain_ids = getChainIds(self.chain_name.get())
-
-        cleanedPDB = cleanPDB(self.inputAtomStruct.get().getFileName(), fnPdb,
-                               False, self.HETATM.get(), chain_ids)
-
-        args = os.path.abspath(cleanedPDB)
-        lephar_plugin.runLePhar(self, program=self._program, args=args, cwd=self._getExtraPath())
+        if not self.isBatch():
+            self.prepareStructure(self.inputAtomStruct.get().getFileName(), self._getExtraPath())
+        else:
+            inFiles = [(item.getObjId(), item.getFileName()) for item in self.inputAtomStruct.get()]
+            self.prepareStructures(inFiles)
 
     def createOutputStep(self):
-        outFileName = self._getPath(self._getInputName() + '_prep.pdb')
-        os.rename(self._getExtraPath('pro.pdb'), outFileName)
-        self.addPDBColumns(outFileName)
-        outAS = AtomStruct(outFileName)
-        self._defineOutputs(outputStructure=outAS)
+        if not self.isBatch():
+            outFileName = self._getPath(self._getInputName() + '_prep.pdb')
+            os.rename(self._getExtraPath('pro.pdb'), outFileName)
+            self.addPDBColumns(outFileName)
+            outAS = AtomStruct(outFileName)
+            self._defineOutputs(outputStructure=outAS)
+        else:
+            outSet = SetOfAtomStructs().create(outputPath=self._getPath())
+            for item in self.inputAtomStruct.get():
+                outFileName = self.getPreparedFile(item.getObjId(), item.getFileName())
+                if os.path.exists(outFileName):
+                    outSet.append(AtomStruct(outFileName))
+            if len(outSet) == 0:
+                raise Exception('None of the input structures could be prepared. The errors of each structure are '
+                                'in the run log')
+            self._defineOutputs(outputAtomStructs=outSet)
+
+    def _summary(self):
+        summary = []
+        if self.isBatch() and hasattr(self, 'outputAtomStructs'):
+            summary.append('{} of {} structures prepared'.format(len(self.outputAtomStructs),
+                                                                 len(self.inputAtomStruct.get())))
+        if self.isBatch() and os.path.exists(self.getFailedFile()):
+            summary.append('Preparation failed for structures: {}'.format(
+                ', '.join([line.replace('\t', ' (') + ')' for line in readListFile(self.getFailedFile())])))
+        return summary
 
     ########################### Utils functions ############################
 
-    def _getInputName(self):
-        return os.path.splitext(os.path.basename(self.inputAtomStruct.get().getFileName()))[0]
+    def isBatch(self):
+        return isinstance(self.inputAtomStruct.get(), SetOfAtomStructs)
+
+    def _getInputName(self, inFile=None):
+        inFile = inFile if inFile else self.inputAtomStruct.get().getFileName()
+        return os.path.splitext(os.path.basename(inFile))[0]
+
+    def getStructureDir(self, objId):
+        return self._getExtraPath('structure_{}'.format(objId))
+
+    def getPreparedFile(self, objId, inFile):
+        return os.path.join(self.getStructureDir(objId), self._getInputName(inFile) + '_prep.pdb')
+
+    def getFailedFile(self):
+        return self._getExtraPath('failed.tsv')
+
+    def getCleanFile(self, pdbFile, outDir):
+        return os.path.join(outDir, '%s_clean.pdb' % self._getInputName(pdbFile))
+
+    def getChainIds(self):
+        return getChainIds(self.chain_name.get()) if self.rchains.get() else None
+
+    def cleanStructure(self, pdbFile, outDir):
+            return cleanPDB(pdbFile, self.getCleanFile(pdbFile, outDir), False, self.HETATM.get(), self.getChainIds())
+
+    def prepareStructure(self, pdbFile, outDir):
+        '''Cleans the PDB file and runs lepro on it in outDir. Returns the lepro output file'''
+        args = os.path.abspath(self.cleanStructure(pdbFile, outDir))
+        lephar_plugin.runLePhar(self, program=self._program, args=args, cwd=outDir)
+        return os.path.join(outDir, 'pro.pdb')
+
+    def prepareStructures(self, inFiles):
+        '''Prepares each structure in its own directory, since lepro always writes pro.pdb in its cwd. The whole
+        preparation of each structure (cleaning, lepro and PDB columns) runs as a task of a process pool'''
+        leproCmd, env = lephar_plugin.getLePharProgram(self._program), lephar_plugin.getEnviron()
+        with ProcessPoolExecutor(max_workers=max(self.numberOfThreads.get(), 1)) as executor:
+            futures = []
+            for objId, inFile in inFiles:
+                outDir = self.getStructureDir(objId)
+                os.makedirs(outDir, exist_ok=True)
+                futures.append(executor.submit(prepareStructureTask, inFile, self.getCleanFile(inFile, outDir),
+                                               os.path.abspath(self.getPreparedFile(objId, inFile)),
+                                               self.HETATM.get(), self.getChainIds(), leproCmd, env))
+
+            failed = []
+            for (objId, inFile), future in zip(inFiles, futures):
+                try:
+                    error = future.result()
+                except Exception as e:
+                    error = str(e)
+                if error is not None:
+                    print('Preparation of structure {} ({}) failed:\n{}'.format(objId, inFile, error))
+                    failed.append('{}\t{}'.format(objId, os.path.basename(inFile)))
+        if failed:
+            writeListFile(self.getFailedFile(), failed)
 
     def addPDBColumns(self, pdbFile):
-        auxFile = self._getTmpPath(os.path.basename(pdbFile))
-        with open(pdbFile) as fIn:
-            with open(auxFile, 'w') as f:
-                for line in fIn:
-                    if line.startswith('ATOM'):
-                        atomSym = removeNumberFromStr(line.split()[2])
-                        line = line.strip() + '  1.00  0.00{}{}\n'.format(' '*11, atomSym)
-                    f.write(line)
-        os.rename(auxFile, pdbFile)
-        return pdbFile
\ No newline at end of file
+        return addPDBColumns(pdbFile, rightAlign=False)
@@ -0,0 +1,163 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+NumPy based handling of the LeDock structures and scores: receptor cropping, pose coordinates and RMSD, and the
+score table of a docking. Kept apart from lephar.utils, so that the plugin and the benchmarks do not depend on NumPy
+"""
+
+import numpy as np
+
+from lephar.utils import openFile
+
+
+########################### Receptor cropping ###########################
+
+def cropReceptor(pdbFile, outFile, center, radius, margin):
+    '''Writes the residues of a PDB file with any atom inside the cubic box of center and radius (half side)
+    enlarged by margin. Returns the number of atoms written'''
+    with openFile(pdbFile) as f:
+        atomLines = [line for line in f if line.startswith(('ATOM', 'HETATM'))]
+    coords = np.array([(line[30:38], line[38:46], line[46:54]) for line in atomLines], dtype=float).reshape(-1, 3)
+    inBox = np.all(np.abs(coords - np.array(center, dtype=float)) <= radius + margin, axis=1)
+
+    # Residues identified by chain, number and insertion code
+    _, resIdxs = np.unique([line[21:27] for line in atomLines], return_inverse=True)
+    keepRes = np.zeros(resIdxs.max() + 1 if len(resIdxs) else 0, dtype=bool)
+    keepRes[resIdxs[inBox]] = True
+    keepAtoms = keepRes[resIdxs]
+
+    with openFile(outFile, 'w') as f:
+        f.write(''.join([line for line, keep in zip(atomLines, keepAtoms) if keep]))
+        f.write('END\n')
+    return int(keepAtoms.sum())
+
+############################## Pose RMSD ##############################
+
+def readPoseCoords(poseFile):
+    '''Returns the (nAtoms, 3) array with the coordinates of the atoms in a pose PDB file (plain or compressed)'''
+    with openFile(poseFile) as f:
+        coords = [(line[30:38], line[38:46], line[46:54]) for line in f if line.startswith(('ATOM', 'HETATM'))]
+    return np.array(coords, dtype=float).reshape(-1, 3)
+
+def getPairwiseRMSD(coords):
+    '''Returns the (nPoses, nPoses) matrix of RMSD (in place, without superposition) between the poses of a
+    (nPoses, nAtoms, 3) coordinates array, all computed at once from their squared norms and dot products'''
+    flat = (coords - coords.mean(axis=(0, 1))).reshape(len(coords), -1)
+    sqNorms = np.einsum('ij,ij->i', flat, flat)
+    sqDists = sqNorms[:, None] + sqNorms[None, :] - 2 * flat @ flat.T
+    return np.sqrt(np.maximum(sqDists, 0) / coords.shape[1])
+
+def selectDistinctPoses(coords, energies, cutoff):
+    '''Returns the sorted indexes of the poses to keep from a (nPoses, nAtoms, 3) coordinates array, best energy
+    first, dropping those under cutoff RMSD from an already kept pose'''
+    rmsd = getPairwiseRMSD(coords)
+    kept = []
+    for i in np.argsort(energies, kind='stable'):
+        if not kept or rmsd[i, kept].min() > cutoff:
+            kept.append(int(i))
+    return sorted(kept)
+
+############################## Score table ##############################
+
+class ScoreTable:
+    '''Docking energies of a screening as a (ligand, pocket, pose) array, with the ligand and pocket names as index.
+    Stored as a .npz file, so it can be ranked and queried without reading the output set.
+    dockKeys contains the key of the docked molecule of each ligand, which names its pose files (they differ from
+    the ligand names when duplicates were docked only once)'''
+    def __init__(self, energies, ligands, pockets, dockKeys=None):
+        self.energies, self.ligands, self.pockets = energies, list(ligands), list(pockets)
+        self.dockKeys = list(dockKeys) if dockKeys is not None else list(ligands)
+
+    @classmethod
+    def fromRecords(cls, records):
+        '''Builds the table from (ligand, pocket, poseId, energy, dockKey) records, with poseId starting at 1'''
+        dockKeys = {rec[0]: rec[4] for rec in records}
+        ligands = sorted(dockKeys)
+        pockets = sorted(set([rec[1] for rec in records]))
+        ligIdxs = {lig: i for i, lig in enumerate(ligands)}
+        pocketIdxs = {pocket: i for i, pocket in enumerate(pockets)}
+        nPoses = max([int(rec[2]) for rec in records]) if records else 0
+
+        energies = np.full((len(ligands), len(pockets), nPoses), np.nan, dtype=np.float32)
+        for ligand, pocket, poseId, energy, _ in records:
+            energies[ligIdxs[ligand], pocketIdxs[pocket], int(poseId) - 1] = energy
+        return cls(energies, ligands, pockets, [dockKeys[lig] for lig in ligands])
+
+    @classmethod
+    def load(cls, tableFile):
+        with np.load(tableFile) as data:
+            return cls(data['energies'], data['ligands'].tolist(), data['pockets'].tolist(), data['dockKeys'].tolist())
+
+    def save(self, tableFile):
+        with open(tableFile, 'wb') as f:
+            np.savez_compressed(f, energies=self.energies, ligands=np.array(self.ligands, dtype=str),
+                                pockets=np.array(self.pockets, dtype=str), dockKeys=np.array(self.dockKeys, dtype=str))
+        return tableFile
+
+    def getDockKey(self, ligand):
+        return self.dockKeys[self.ligands.index(ligand)]
+
+    def _getRecords(self, energies, flatIdxs, pocketIdx=None):
+        records = []
+        for ligIdx, pIdx, poseIdx in zip(*np.unravel_index(flatIdxs, energies.shape)):
+            pIdx = pocketIdx if pocketIdx is not None else pIdx
+            records.append((self.ligands[ligIdx], self.pockets[pIdx], int(poseIdx) + 1,
+                            float(self.energies[ligIdx, pIdx, poseIdx])))
+        return records
+
+    def _getPocketEnergies(self, pocket=None):
+        if pocket is None:
+            return self.energies, None
+        pocketIdx = self.pockets.index(pocket)
+        return self.energies[:, pocketIdx:pocketIdx + 1, :], pocketIdx
+
+    def topN(self, n, pocket=None):
+        '''Returns the (ligand, pocket, poseId, energy) of the n best poses, in a pocket or in all of them'''
+        energies, pocketIdx = self._getPocketEnergies(pocket)
+        flat = np.where(np.isnan(energies), np.inf, energies).ravel()
+        n = min(n, int(np.isfinite(flat).sum()))
+        if n == 0:
+            return []
+        best = np.argpartition(flat, n - 1)[:n]
+        return self._getRecords(energies, best[np.argsort(flat[best], kind='stable')], pocketIdx)
+
+    def bestPerLigand(self):
+        '''Returns a dictionary {ligand: (pocket, poseId, energy)} with the best pose of each docked ligand'''
+        if self.energies.size == 0:
+            return {}
+        flat = np.where(np.isnan(self.energies), np.inf, self.energies).reshape(len(self.ligands), -1)
+        bestIdxs = flat.argmin(axis=1)
+        docked = np.isfinite(flat[np.arange(len(self.ligands)), bestIdxs])
+        flatIdxs = np.ravel_multi_index((np.arange(len(self.ligands)), bestIdxs), flat.shape)[docked]
+        return {rec[0]: rec[1:] for rec in self._getRecords(self.energies, flatIdxs)}
+
+    def underThreshold(self, maxEnergy, pocket=None):
+        '''Returns the (ligand, pocket, poseId, energy) of the poses with an energy under maxEnergy, best first'''
+        energies, pocketIdx = self._getPocketEnergies(pocket)
+        flat = energies.ravel()
+        selected = np.flatnonzero(flat < maxEnergy)
+        return self._getRecords(energies, selected[np.argsort(flat[selected], kind='stable')], pocketIdx)
@@ -0,0 +1,67 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo Gomez (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Computes RDKit descriptors of a list of molecule files. Run in the rdkit2-env environment (python 2.7):
+    python rdkit_descriptors.py <inputList> <outputFile> <descriptor1,descriptor2,...>
+inputList contains a line per molecule with its key and file: <key>\t<file>
+outputFile is written with a line per key and descriptor: <key>\t<descriptor>\t<value>
+"""
+
+import os, sys
+
+from rdkit import Chem
+from rdkit.Chem import Descriptors
+
+
+def readMolecule(molFile):
+    ext = os.path.splitext(molFile)[1]
+    if ext == '.mol2':
+        return Chem.MolFromMol2File(molFile)
+    elif ext in ['.sdf', '.mol']:
+        return next(iter(Chem.SDMolSupplier(molFile)), None)
+    elif ext == '.pdb':
+        return Chem.MolFromPDBFile(molFile)
+    elif ext == '.smi':
+        with open(molFile) as f:
+            return Chem.MolFromSmiles(f.readline().split()[0])
+
+def calcDescriptor(mol, descName):
+    if descName == 'NumChiralCenters':
+        return len(Chem.FindMolChiralCenters(mol, includeUnassigned=True))
+    return getattr(Descriptors, descName)(mol)
+
+
+if __name__ == "__main__":
+    inputList, outputFile, descNames = sys.argv[1], sys.argv[2], sys.argv[3].split(',')
+    with open(inputList) as fIn:
+        with open(outputFile, 'w') as f:
+            for line in fIn:
+                key, molFile = line.strip().split('\t')
+                mol = readMolecule(molFile)
+                for descName in descNames:
+                    value = calcDescriptor(mol, descName) if mol is not None else float('nan')
+                    f.write('{}\t{}\t{}\n'.format(key, descName, value))
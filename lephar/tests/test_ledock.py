@@ -24,9 +24,17 @@
 # *
 # **************************************************************************
 
+import os, json, shutil, tempfile
+import numpy as np
+
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
-from pwem.protocols import ProtImportPdb
-from ..protocols import ProtChemLePro, ProtChemLeDock
+from pwem.protocols import ProtImportPdb, ProtImportSetOfAtomStructs
+from ..protocols import ProtChemLePro, ProtChemLeDock, ProtChemLePharFilter
+from ..utils import writeListFile, writeDockInput, getDockBox, runLeDockWatched, packMolLibrary, \
+    extractFromMolLibrary, readClustersFile, estimateInvocationOverhead, getOptimalChunkSize, getSpreadSample
+from ..scoring import selectDistinctPoses, cropReceptor
+from ..benchmarks.fake_lephar import writeFakeLePharHome
+from ..benchmarks.synthetic import writeSyntheticPDB, writeSyntheticMol2, PDB_ATOM_LINE
 from pwchem.protocols import ProtChemImportSmallMolecules, ProtChemOBabelPrepareLigands, ProtDefineStructROIs
 
 
@@ -57,6 +65,24 @@ class TestLePro(BaseTest):
 
         cls.launchProtocol(cls.protPrepareReceptor)
 
+    @classmethod
+    def _runImportPDBs(cls):
+        cls.protImportPDBs = cls.newProtocol(
+            ProtImportSetOfAtomStructs,
+            inputPdbData=0,
+            pdbIds='5ni1, 4erf')
+        cls.proj.launchProtocol(cls.protImportPDBs, wait=False)
+
+    @classmethod
+    def _runPrepareReceptorsLePro(cls):
+        cls.protPrepareReceptors = cls.newProtocol(
+            ProtChemLePro,
+            inputAtomStruct=cls.protImportPDBs.outputAtomStructs,
+            HETATM=False, rchains=False,
+            numberOfThreads=2)
+
+        cls.launchProtocol(cls.protPrepareReceptors)
+
     def test(self):
         self._runPrepareReceptorLePro()
 
@@ -64,6 +90,20 @@ class TestLePro(BaseTest):
         self.assertIsNotNone(getattr(self.protPrepareReceptor, 'outputStructure', None))
 
 
+class TestLeProBatch(TestLePro):
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls._runImportPDBs()
+        cls._waitOutput(cls.protImportPDBs, 'outputAtomStructs', sleepTime=5)
+
+    def test(self):
+        self._runPrepareReceptorsLePro()
+
+        self._waitOutput(self.protPrepareReceptors, 'outputAtomStructs', sleepTime=10)
+        self.assertEqual(len(self.protPrepareReceptors.outputAtomStructs), 2)
+
+
 class TestLeDock(TestLePro):
     @classmethod
     def setUpClass(cls):
@@ -110,7 +150,7 @@ class TestLeDock(TestLePro):
         cls.proj.launchProtocol(cls.protDefPockets, wait=False)
         return cls.protDefPockets
 
-    def _runLeDock(self, pocketsProt=None):
+    def _runLeDock(self, pocketsProt=None, **kwargs):
         if pocketsProt == None:
             protAutoDock = self.newProtocol(
                 ProtChemLeDock,
@@ -118,7 +158,7 @@ class TestLeDock(TestLePro):
                 inputAtomStruct=self.protPrepareReceptor.outputStructure,
                 inputSmallMolecules=self.protOBabel.outputSmallMolecules,
                 radius=24, nRuns=2,
-                numberOfThreads=1)
+                numberOfThreads=1, **kwargs)
             self.proj.launchProtocol(protAutoDock, wait=False)
 
         else:
@@ -128,7 +168,7 @@ class TestLeDock(TestLePro):
                 inputStructROIs=pocketsProt.outputStructROIs,
                 inputSmallMolecules=self.protOBabel.outputSmallMolecules,
                 pocketRadiusN=5, nRuns=2,
-                numberOfThreads=4)
+                numberOfThreads=4, **kwargs)
             self.proj.launchProtocol(protAutoDock, wait=False)
 
         return protAutoDock
@@ -148,4 +188,246 @@ class TestLeDock(TestLePro):
         self._waitOutput(protLeDock2, 'outputSmallMolecules', sleepTime=10)
         self.assertIsNotNone(getattr(protLeDock2, 'outputSmallMolecules', None))
 
+    def testEnsemble(self):
+        print('Docking with LeDock in the whole protein of a receptor ensemble')
+        self._runImportPDBs()
+        self._waitOutput(self.protImportPDBs, 'outputAtomStructs', sleepTime=5)
+        self._runPrepareReceptorsLePro()
+        receptors = self.protPrepareReceptors.outputAtomStructs
+
+        protLeDock = self._runLeDock(doEnsemble=True, inputReceptors=receptors)
+        for receptor in receptors:
+            outputName = 'outputSmallMolecules_{}'.format(receptor.getObjId())
+            self._waitOutput(protLeDock, outputName, sleepTime=10)
+            outputSet = getattr(protLeDock, outputName, None)
+            self.assertIsNotNone(outputSet)
+            self.assertEqual(outputSet.getProteinFile(), receptor.getFileName())
+        self.assertTrue(os.path.exists(protLeDock.getEnsembleBestFile()))
+
+    def testFunnel(self):
+        print('Funnel docking with LeDock in predicted pockets')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self._runLeDock(protStructROIs, doFunnel=True, funnelTopPerc=50)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+
+    def testStaged(self):
+        print('Coarse then fine docking with LeDock in predicted pockets')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self._runLeDock(protStructROIs, doStaged=True, coarseRuns=1, fineTopPerc=50)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+
+    def testFilter(self):
+        print('Filtering the ligands by descriptors before docking with LeDock')
+        protFilter = self.newProtocol(
+            ProtChemLePharFilter,
+            inputSmallMolecules=self.protOBabel.outputSmallMolecules,
+            filtersList='1) Descriptor: HeavyAtomCount\t5.0\t60.0\n2) Descriptor: MolLogP\t-5.0\t7.0\n',
+            numberOfThreads=2)
+        self.proj.launchProtocol(protFilter, wait=False)
+        self._waitOutput(protFilter, 'outputSmallMolecules', sleepTime=5)
+        self.assertIsNotNone(getattr(protFilter, 'outputSmallMolecules', None))
+
+    def testDedup(self):
+        print('Docking the unique ligands (conformers collapsed) with LeDock in the whole protein')
+        protLeDock = self._runLeDock(doDedup=True)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+
+        # The conformers are collapsed and the poses of each docked molecule assigned to all of them
+        groups = readClustersFile(protLeDock.getDuplicatesFile())
+        self.assertLess(len(groups), len(self.protOBabel.outputSmallMolecules))
+        self.assertGreater(len(protLeDock.outputSmallMolecules), len(groups))
+
+    def testAutoChunk(self):
+        print('Docking with LeDock in predicted pockets with the chunk size tuned by each job')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self._runLeDock(protStructROIs, autoChunk=True)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+        self.assertTrue(any([file.startswith('chunks_') for file in os.listdir(protLeDock.getProfileDir())]))
+
+    def testCropReceptor(self):
+        print('Docking with LeDock in predicted pockets on the receptor cropped around each of them')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self._runLeDock(protStructROIs, cropReceptor=True, cropMargin=8.0)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+        for pocket in protStructROIs.outputStructROIs:
+            self.assertTrue(os.path.exists(protLeDock.getDockReceptorFile(pocket)))
+
+    def testCrossDedup(self):
+        print('Docking with LeDock in predicted pockets removing the duplicate poses across them')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self._runLeDock(protStructROIs, crossDedup=True)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+        self.assertTrue(os.path.exists(protLeDock.getCrossDuplicatesFile()))
+
+    def testPackLibrary(self):
+        print('Docking with LeDock in predicted pockets the ligands sliced from a packed library')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self._runLeDock(protStructROIs, packLibrary=True)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+        self.assertTrue(os.path.exists(protLeDock.getLibraryIndexFile()))
+
+    def testPublishPartial(self):
+        print('Docking with LeDock in the whole protein publishing the results while docking')
+        protLeDock = self._runLeDock(publishPartial=True, publishPeriod=0.1)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+
+    def testDryRun(self):
+        print('Planning a LeDock screen in predicted pockets without docking it')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self.newProtocol(
+            ProtChemLeDock,
+            wholeProt=False,
+            inputStructROIs=protStructROIs.outputStructROIs,
+            inputSmallMolecules=self.protOBabel.outputSmallMolecules,
+            pocketRadiusN=5, nRuns=2,
+            dryRun=True, dryRunSample=3,
+            numberOfThreads=1)
+        self.launchProtocol(protLeDock)
+        self.assertTrue(os.path.exists(protLeDock.getPlanFile()))
+
+        # More pockets than threads: each pocket is timed from the start of its own calibration job, so the wait
+        # for the thread is not taken as ledock startup time
+        with open(protLeDock.getPlanFile()) as f:
+            plan = json.load(f)
+        self.assertEqual(plan['sample'], 3)
+        self.assertEqual(len(plan['targets']), len(protStructROIs.outputStructROIs))
+        self.assertGreater(len(plan['targets']), plan['threads'])
+        for target in plan['targets'].values():
+            self.assertLessEqual(target['overhead'] + 3 * target['perLigand'], target['calibrationSeconds'] + 1)
+        self.assertGreater(plan['cpuSeconds'], 0)
+
+    def testStagedPublishPartial(self):
+        print('Coarse then fine docking with LeDock in local scratch, compressed, publishing the results while docking')
+        protStructROIs = self._runPocketsSearch()
+        self._waitOutput(protStructROIs, 'outputStructROIs', sleepTime=5)
+
+        protLeDock = self._runLeDock(protStructROIs, doStaged=True, coarseRuns=1, fineTopPerc=50,
+                                     publishPartial=True, publishPeriod=0.1, useScratch=True, compression=1)
+        self._waitOutput(protLeDock, 'outputSmallMolecules', sleepTime=10)
+        self.assertIsNotNone(getattr(protLeDock, 'outputSmallMolecules', None))
+
+
+class TestLePharUtils(BaseTest):
+    """Offline checks of the lephar helpers, running the fake LePhar binaries of the benchmarks when needed"""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def _writeLigands(self, nAtomsList, missing=()):
+        ligDir = os.path.join(self.tmpDir, 'ligands')
+        os.makedirs(ligDir, exist_ok=True)
+        ligFiles = [os.path.join(ligDir, 'lig{}.mol2'.format(i)) for i in range(len(nAtomsList))]
+        for i, (ligFile, nAtoms) in enumerate(zip(ligFiles, nAtomsList)):
+            if i not in missing:
+                writeSyntheticMol2(ligFile, nAtoms, seed=i)
+        return ligFiles
+
+    def _getFakeLeDockCmd(self, ligFiles, name='dock'):
+        binDir = writeFakeLePharHome(os.path.join(self.tmpDir, 'lephar'))
+        recFile = writeSyntheticPDB(os.path.join(self.tmpDir, 'pro.pdb'), 100)
+        ligList = writeListFile(os.path.join(self.tmpDir, '{}.list'.format(name)), ligFiles)
+        dockFile = writeDockInput(os.path.join(self.tmpDir, '{}.in'.format(name)), recFile, 1.0,
+                                  getDockBox((0, 0, 0), 10), 1, ligList)
+        return [os.path.join(binDir, 'ledock_linux_x86'), dockFile]
+
+    def testLeDockWatched(self):
+        # lig1 is skipped by ledock (unreadable) and lig3 exceeds the time limit
+        ligFiles = self._writeLigands([10, 10, 10, 500, 10], missing=[1])
+        dokFiles = [os.path.splitext(ligFile)[0] + '.dok' for ligFile in ligFiles]
+        env = dict(os.environ, FAKE_LEDOCK_SLEEP_ATOM='0.01')
+
+        retCode, nProcessed = runLeDockWatched(self._getFakeLeDockCmd(ligFiles), dokFiles, 1.5, cwd=self.tmpDir,
+                                               env=env, poll=0.2)
+        self.assertIsNone(retCode)
+        self.assertEqual(nProcessed, 3)
+        self.assertEqual(ligFiles[nProcessed], ligFiles[3])
+        self.assertFalse(os.path.exists(dokFiles[4]))
+
+        # Restarted with the ligands after the quarantined one
+        retCode, nProcessed = runLeDockWatched(self._getFakeLeDockCmd(ligFiles[4:], 'retry'), dokFiles[4:], 1.5,
+                                               cwd=self.tmpDir, env=env, poll=0.2)
+        self.assertEqual((retCode, nProcessed), (0, 1))
+
+    def testMolLibrary(self):
+        ligFiles = self._writeLigands([10, 25, 40, 15])
+        contents = []
+        for ligFile in ligFiles:
+            with open(ligFile) as f:
+                contents.append(f.read())
+
+        libFile, indexFile = os.path.join(self.tmpDir, 'library.mol2'), os.path.join(self.tmpDir, 'library.idx')
+        packMolLibrary(ligFiles, libFile, indexFile)
+        self.assertFalse(any([os.path.exists(ligFile) for ligFile in ligFiles]))
+
+        outDir = os.path.join(self.tmpDir, 'job')
+        os.mkdir(outDir)
+        names = [os.path.basename(ligFiles[i]) for i in [3, 0, 2]]
+        outFiles = extractFromMolLibrary(libFile, indexFile, names, outDir)
+        self.assertEqual(outFiles, [os.path.join(outDir, name) for name in names])
+        for outFile, i in zip(outFiles, [3, 0, 2]):
+            with open(outFile) as f:
+                self.assertEqual(f.read(), contents[i])
+
+    def testDistinctPoses(self):
+        base = np.arange(15, dtype=float).reshape(5, 3)
+        shift = np.array([0.5, 0, 0])
+        # Pose 0 is 0.5 A from pose 1, and pose 3 0.2 A from pose 2, which is far from both
+        coords = np.stack([base, base + shift, base + 10 * shift, base + 10.4 * shift])
+        self.assertEqual(selectDistinctPoses(coords, [-5.0, -7.0, -6.0, -4.0], 1.0), [1, 2])
+        self.assertEqual(selectDistinctPoses(coords, [-5.0, -7.0, -6.0, -4.0], 0.1), [0, 1, 2, 3])
+
+    def testChunkSize(self):
+        # The first ligand pays the ledock startup, the time per ligand is the median of the rest
+        ligTimes = [('lig0.dok', 12.0), ('lig1.dok', 2.0), ('lig2.dok', 3.0)]
+        self.assertEqual(estimateInvocationOverhead(ligTimes), (10.0, 2.0))
+        self.assertEqual(estimateInvocationOverhead(ligTimes, [1.0, 1.0, 1.5]), (10.0, 2.0))
+        self.assertEqual(estimateInvocationOverhead(ligTimes[:1]), (None, None))
+
+        self.assertEqual(getOptimalChunkSize(100, 4.0, 1.0), 20)
+        self.assertEqual(getOptimalChunkSize(10, 1000.0, 1.0), 10)
+        self.assertEqual(getOptimalChunkSize(100, None, None), 100)
+
+        sample, rest = getSpreadSample(list(range(10)), 3)
+        self.assertEqual(sample, [0, 3, 6])
+        self.assertEqual(rest, [1, 2, 4, 5, 7, 8, 9])
+
+    def testCropReceptor(self):
+        # Residue 1 has an atom in the box, residue 2 is far and residue 3 is inside the margin
+        atoms = [(1, 1.0, 1.0, 1.0), (1, 20.0, 20.0, 20.0), (2, 30.0, 0.0, 0.0), (2, 31.0, 0.0, 0.0),
+                 (3, 6.5, 0.0, 0.0)]
+        pdbFile = os.path.join(self.tmpDir, 'pro.pdb')
+        with open(pdbFile, 'w') as f:
+            for i, (resNum, x, y, z) in enumerate(atoms):
+                f.write(PDB_ATOM_LINE.format(i + 1, 'CA', 'ALA', 'A', resNum, x, y, z))
+            f.write('END\n')
 
+        cropFile = os.path.join(self.tmpDir, 'pro_crop.pdb')
+        self.assertEqual(cropReceptor(pdbFile, cropFile, (0, 0, 0), 5.0, 2.0), 3)
+        with open(cropFile) as f:
+            lines = f.readlines()
+        self.assertEqual([int(line[22:26]) for line in lines if line.startswith('ATOM')], [1, 1, 3])
+        self.assertEqual(lines[-1], 'END\n')
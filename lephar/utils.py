@@ -0,0 +1,1104 @@
+# **************************************************************************
+# *
+# * Authors:    Carlos Oscar Sorzano (coss@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, io, bisect, csv, fcntl, glob, gzip, hashlib, heapq, json, math, mmap, shutil, signal, subprocess, tarfile, \
+    tempfile, threading, time, queue
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from lephar.constants import DOCK_IN, PROGRESS_PERIOD, CALIBRATION_LIGANDS
+
+SCORE_TAG = 'Score:'
+JobResult = namedtuple('JobResult', ['cmd', 'cwd', 'returncode', 'stdout', 'stderr', 'elapsed', 'start'])
+
+# Default relative cost of docking a ligand: intercept, per heavy atom, per rotatable bond
+DEFAULT_COST_COEFS = (1.0, 0.05, 0.5)
+PDB_EXTRA_COLS = '  1.00  0.00'
+PDB_BLOCK_LINES = 65536
+# .dok files checked past the last one written when watching a ledock run, which may skip some ligands
+WATCH_LOOKAHEAD = 16
+# Compression formats: extension of their files
+COMPRESSION_EXTS = {'gzip': '.gz', 'zstd': '.zst'}
+DOCK_EXT = '.dok'
+
+################################# Files #################################
+
+def getLigandKey(molFile):
+    '''Returns the ligand identifier used by LeDock to name its outputs (<key>.dok) from a ligand file'''
+    return os.path.basename(molFile).split('.')[0]
+
+def readListFile(listFile):
+    '''Returns the non empty lines of a list file'''
+    with open(listFile) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def writeListFile(listFile, items):
+    '''Writes a list file with an item per line'''
+    with open(listFile, 'w') as f:
+        f.write(''.join(['{}\n'.format(item) for item in items]))
+    return listFile
+
+def publishListFile(listFile, items):
+    '''Writes a list file atomically, so concurrent readers never find it incomplete'''
+    writeListFile(listFile + '.tmp', items)
+    os.replace(listFile + '.tmp', listFile)
+    return listFile
+
+def claimFile(fileName):
+    '''Atomically claims a file for the calling process by creating its .claim file.
+    Returns False if it was already claimed'''
+    try:
+        os.close(os.open(fileName + '.claim', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+def linkLocal(sourcePath, outDir):
+    '''Links a file into outDir (if not already there) and returns its basename'''
+    outFile = os.path.join(outDir, os.path.basename(sourcePath))
+    if not os.path.exists(outFile):
+        os.symlink(sourcePath, outFile)
+    return os.path.basename(sourcePath)
+
+def getScratchRoot(scratchDir=None):
+    '''Returns the local scratch directory to use: scratchDir if provided, $TMPDIR or the system temporary dir'''
+    return scratchDir or os.environ.get('TMPDIR') or tempfile.gettempdir()
+
+def copyFiles(files, outDir):
+    '''Copies the files (following links) into outDir and returns the copies'''
+    return [shutil.copy(file, outDir) for file in files]
+
+def stageScratchDir(scratchRoot, prefix, files):
+    '''Creates a job directory in the scratch root and copies the files (following links) into it'''
+    os.makedirs(scratchRoot, exist_ok=True)
+    workDir = tempfile.mkdtemp(prefix=prefix, dir=scratchRoot)
+    copyFiles(files, workDir)
+    return workDir
+
+def packDockResults(workDir, archiveFile, exts=('.dok', '.dok.gz', '.dok.zst', '.log')):
+    '''Packs the docking results of a job directory into a tar archive, written locally and then copied into its
+    final location with a single sequential write'''
+    localArchive = os.path.join(workDir, os.path.basename(archiveFile))
+    with tarfile.open(localArchive, 'w') as tar:
+        for entry in os.scandir(workDir):
+            if entry.name.endswith(exts):
+                tar.add(entry.path, arcname=entry.name)
+    shutil.copy(localArchive, archiveFile)
+    return archiveFile
+
+def getDockArchives(pocketDir):
+    '''Returns the docking results archives of a pocket directory, sorted by stage'''
+    archives = [entry.path for entry in os.scandir(pocketDir)
+                if entry.name.startswith('docks_') and '.tar' in entry.name]
+    return sorted(archives, key=lambda f: int(os.path.basename(f).split('_')[1]))
+
+def extractDockArchives(pocketDir):
+    '''Extracts and removes the docking results archives of a pocket, later stages overwriting earlier ones'''
+    for archive in getDockArchives(pocketDir):
+        with tarfile.open(archive) as tar:
+            tar.extractall(pocketDir)
+        os.remove(archive)
+
+########################### Ligand library ############################
+
+def packMolLibrary(molFiles, libFile, indexFile, remove=True):
+    '''Concatenates the ligand files into a single library file and writes its index, a line per ligand with its
+    file basename, byte offset and size in the library. The ligand files are removed unless remove is False'''
+    offset = 0
+    with open(libFile, 'wb') as fLib, open(indexFile, 'w') as fIdx:
+        for molFile in molFiles:
+            size = os.path.getsize(molFile)
+            with open(molFile, 'rb') as f:
+                shutil.copyfileobj(f, fLib)
+            fIdx.write('{}\t{}\t{}\n'.format(os.path.basename(molFile), offset, size))
+            offset += size
+            if remove:
+                os.remove(molFile)
+    return libFile
+
+def readMolLibraryIndex(indexFile):
+    '''Returns a dictionary {ligand file basename: (offset, size)} from a library index file'''
+    index = {}
+    with open(indexFile) as f:
+        for line in f:
+            name, offset, size = line.split('\t')
+            index[name] = (int(offset), int(size))
+    return index
+
+def extractFromMolLibrary(libFile, indexFile, names, outDir):
+    '''Writes the ligand files with the names (basenames) into outDir, slicing them from the memory mapped
+    library. Returns the written files'''
+    index, outFiles = readMolLibraryIndex(indexFile), []
+    with open(libFile, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as lib:
+            for name in names:
+                offset, size = index[name]
+                outFile = os.path.join(outDir, name)
+                with open(outFile, 'wb') as fOut:
+                    fOut.write(lib[offset:offset + size])
+                outFiles.append(outFile)
+    return outFiles
+
+############################## Compression ##############################
+
+def getCompressionExt(compression):
+    return COMPRESSION_EXTS.get(compression, '')
+
+def stripCompressionExt(fileName):
+    for ext in COMPRESSION_EXTS.values():
+        if fileName.endswith(ext):
+            return fileName[:-len(ext)]
+    return fileName
+
+def isZstdAvailable():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+def openFile(fileName, mode='r', fileObj=None):
+    '''Opens a file, plain or compressed with any of COMPRESSION_EXTS (guessed from its extension), in text
+    mode unless 'b' is in mode. Compressed files are read and written as streams.
+    If fileObj is provided, it is wrapped instead of opening fileName (e.g: members of a tar archive)'''
+    textMode = mode if 'b' in mode else mode + 't'
+    if fileName.endswith(COMPRESSION_EXTS['gzip']):
+        return gzip.open(fileObj or fileName, textMode, compresslevel=6)
+    elif fileName.endswith(COMPRESSION_EXTS['zstd']):
+        import zstandard
+        return zstandard.open(fileObj or fileName, textMode)
+    elif fileObj is not None:
+        return fileObj if 'b' in mode else io.TextIOWrapper(fileObj)
+    return open(fileName, mode)
+
+def compressFile(fileName, compression, remove=True):
+    '''Compresses a file with the compression format (see COMPRESSION_EXTS) and returns the compressed file name.
+    The original file is removed unless remove is False'''
+    outFile = fileName + getCompressionExt(compression)
+    if outFile == fileName:
+        return fileName
+    with open(fileName, 'rb') as fIn:
+        with openFile(outFile, 'wb') as f:
+            shutil.copyfileobj(fIn, f)
+    if remove:
+        os.remove(fileName)
+    return outFile
+
+def decompressFile(fileName, remove=True):
+    '''Decompresses a file next to it and returns the decompressed file name. Plain files are left untouched'''
+    outFile = stripCompressionExt(fileName)
+    if outFile == fileName:
+        return fileName
+    with openFile(fileName, 'rb') as fIn:
+        with open(outFile, 'wb') as f:
+            shutil.copyfileobj(fIn, f)
+    if remove:
+        os.remove(fileName)
+    return outFile
+
+############################## Dock inputs ##############################
+
+def getDockBox(center, radius):
+    '''Returns the (xmin, xmax, ymin, ymax, zmin, zmax) limits of a cubic docking box'''
+    box = []
+    for c in center:
+        box += [c - radius, c + radius]
+    return box
+
+def writeDockInput(dockFile, receptor, rmsTol, box, nRuns, ligList):
+    '''Writes a ledock input file'''
+    with open(dockFile, 'w') as fIn:
+        fIn.write(DOCK_IN.format(receptor, rmsTol, *box, nRuns, ligList))
+    return dockFile
+
+############################## Execution ##############################
+
+def killProcessGroup(proc):
+    '''Kills a process started in its own session together with its children'''
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+# asyncio is imported by the runner functions: it is the slowest import of this module and only needed to run jobs
+
+async def _runCommandAsync(cmd, cwd, env, semaphore, timeout, freeCpuSets):
+    import asyncio
+    async with semaphore:
+        start = time.time()
+        proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        # Each running job takes a CPU set not used by the other running jobs
+        cpus = freeCpuSets.pop() if freeCpuSets else None
+        setProcessAffinity(proc.pid, cpus)
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            returncode = proc.returncode
+        except asyncio.TimeoutError:
+            killProcessGroup(proc)
+            stdout, stderr = await proc.communicate()
+            returncode = None
+        except asyncio.CancelledError:
+            killProcessGroup(proc)
+            # Reaped before the event loop closes, which otherwise complains about the killed process
+            await asyncio.shield(proc.wait())
+            raise
+        finally:
+            if cpus is not None:
+                freeCpuSets.append(cpus)
+        return JobResult(cmd, cwd, returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace'),
+                         time.time() - start, start)
+
+async def _runCommandsAsync(jobs, maxJobs, env, timeout, check, cpuSets):
+    import asyncio
+    semaphore, freeCpuSets = asyncio.Semaphore(maxJobs), list(cpuSets or [])
+    tasks = [asyncio.ensure_future(_runCommandAsync(cmd, cwd, env, semaphore, timeout, freeCpuSets))
+             for cmd, cwd in jobs]
+    try:
+        for future in asyncio.as_completed(tasks):
+            result = await future
+            if check and result.returncode != 0:
+                raise Exception('Command {} in {} failed with code {}:\n{}'.
+                                format(' '.join(result.cmd), result.cwd, result.returncode, result.stderr))
+    except BaseException:
+        # Cancel (and kill) the pending jobs
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return [task.result() for task in tasks]
+
+def runCommands(jobs, maxJobs=1, env=None, timeout=None, check=True, cpuSets=None):
+    '''Runs a list of (argv, cwd) commands without shell, with at most maxJobs running at the same time.
+    The stdout and stderr of each job are captured. Jobs exceeding the timeout (seconds) are killed and get a None
+    return code. If check, the first failed job cancels the pending ones and raises an exception.
+    If cpuSets (see getWorkerCpuSets) are given, each running job is pinned to one of them.
+    Returns the list of JobResult in the same order as the jobs, with the time each job started running (after
+    waiting for a free slot) and its elapsed seconds'''
+    if not jobs:
+        return []
+    import asyncio
+    return asyncio.run(_runCommandsAsync(jobs, max(maxJobs, 1), env, timeout, check, cpuSets))
+
+def isDockDone(dokFile, start):
+    '''Whether a ligand .dok file has been written after start'''
+    try:
+        return os.path.getmtime(dokFile) >= start
+    except OSError:
+        return False
+
+def getProcessedLigands(dokFiles, start, nProcessed=0, lookahead=WATCH_LOOKAHEAD):
+    '''Returns the number of ligands of a ledock run started at start that it has already processed, knowing that
+    nProcessed were. ledock may skip a ligand without writing its .dok file, so the count goes up to the last .dok
+    file written, looking up to lookahead files past the processed ones each time'''
+    advanced = True
+    while advanced:
+        advanced = False
+        for i in range(min(nProcessed + lookahead, len(dokFiles)) - 1, nProcessed - 1, -1):
+            if isDockDone(dokFiles[i], start):
+                nProcessed, advanced = i + 1, True
+                break
+    return nProcessed
+
+def runLeDockWatched(cmd, dokFiles, ligTimeout, cwd=None, env=None, logFile=None, poll=1.0, cpus=None):
+    '''Runs a ledock command (argv list) whose ligands produce dokFiles in order, killing it if no ligand finishes in
+    more than ligTimeout seconds. Only the .dok files following the last one written are checked in each poll
+    (see getProcessedLigands). The process is pinned to cpus if given.
+    Returns the return code (None if killed) and the number of ligands processed (docked or skipped by ledock), so
+    the ligand being docked when killed is dokFiles[nProcessed]'''
+    start = time.time()
+    fLog = open(logFile, 'a') if logFile else subprocess.DEVNULL
+    try:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=fLog, stderr=subprocess.STDOUT, start_new_session=True)
+        setProcessAffinity(proc.pid, cpus)
+        nProcessed, lastProgress = 0, start
+        while True:
+            try:
+                retCode = proc.wait(timeout=poll)
+            except subprocess.TimeoutExpired:
+                retCode = None
+
+            newProcessed = getProcessedLigands(dokFiles, start, nProcessed)
+            if newProcessed > nProcessed:
+                nProcessed, lastProgress = newProcessed, time.time()
+
+            if retCode is not None:
+                return retCode, nProcessed
+            if nProcessed < len(dokFiles) and time.time() - lastProgress > ligTimeout:
+                killProcessGroup(proc)
+                proc.wait()
+                return None, nProcessed
+    finally:
+        if logFile:
+            fLog.close()
+
+############################## PDB columns ##############################
+
+_pdbTails = ({}, {})
+
+def getPDBColumnsTail(atomName, rightAlign=True):
+    '''Returns the occupancy, B-factor and element columns to append to an ATOM line given its atom name.
+    The element is the atom name without numbers, right aligned to the element column if rightAlign or after
+    a fixed padding otherwise (as done for lepro outputs)'''
+    tails = _pdbTails[rightAlign]
+    tail = tails.get(atomName)
+    if tail is None:
+        atomSym = ''.join([c for c in atomName if not c.isdigit()])
+        pad = 12 - len(atomSym) if rightAlign else 11
+        tail = tails[atomName] = '{}{}{}\n'.format(PDB_EXTRA_COLS, ' ' * pad, atomSym)
+    return tail
+
+def addPDBColumnsToLines(lines, rightAlign=True):
+    '''Returns the list of PDB lines with the occupancy, B-factor and element columns appended to the ATOM
+    lines. The atom name is read from its fixed width columns'''
+    outLines = []
+    for line in lines:
+        if line.startswith('ATOM'):
+            atomName = line[12:16].strip() or line.split()[2]
+            line = line.rstrip() + getPDBColumnsTail(atomName, rightAlign)
+        outLines.append(line)
+    return outLines
+
+def addPDBColumnsToStr(pdbStr, rightAlign=True):
+    '''In memory version of addPDBColumns, operating on the PDB file content'''
+    return ''.join(addPDBColumnsToLines(pdbStr.splitlines(True), rightAlign))
+
+def addPDBColumns(pdbFile, outFile=None, rightAlign=True):
+    '''Appends the occupancy, B-factor and element columns to the ATOM lines of a PDB file, reading and writing it
+    in blocks of lines. If not outFile provided, pdbFile will be replaced. Any of the files may be compressed'''
+    auxFile = outFile if outFile else os.path.join(os.path.dirname(pdbFile), 'aux_' + os.path.basename(pdbFile))
+    with openFile(pdbFile) as fIn:
+        with openFile(auxFile, 'w') as f:
+            lines = fIn.readlines(PDB_BLOCK_LINES)
+            while lines:
+                f.write(''.join(addPDBColumnsToLines(lines, rightAlign)))
+                lines = fIn.readlines(PDB_BLOCK_LINES)
+
+    if not outFile:
+        outFile = pdbFile
+        os.replace(auxFile, outFile)
+    return outFile
+
+############################## Dock outputs ##############################
+
+def isDockFile(fileName):
+    '''Whether the file is a LeDock .dok file, plain or compressed'''
+    return stripCompressionExt(fileName).endswith(DOCK_EXT)
+
+def compressDockFiles(dokFiles, compression):
+    '''Compresses the existing .dok files and returns the compressed file names'''
+    return [compressFile(dokFile, compression) for dokFile in dokFiles if os.path.exists(dokFile)]
+
+def parseDockEnergies(dokFile):
+    '''Returns the list of energies of the poses in a LeDock .dok file (plain or compressed), in the same order'''
+    with openFile(dokFile) as f:
+        return parseDockEnergyLines(f)
+
+def parseDockEnergyLines(lines):
+    return [float(line.split()[-2]) for line in lines if SCORE_TAG in line]
+
+def moveToSplitDir(dockFile, outDir):
+    '''Moves a .dok file into its own directory inside outDir, where ledock -spli will write its poses.
+    Returns the new path of the .dok file'''
+    dockBase = os.path.basename(dockFile)
+    dockDir = os.path.join(outDir, dockBase.split('.')[0])
+    os.mkdir(dockDir)
+
+    newDockFile = os.path.join(dockDir, dockBase)
+    # The .dok file may come from a local scratch directory in another file system
+    shutil.move(dockFile, newDockFile)
+    # ledock -spli only reads plain .dok files
+    return decompressFile(newDockFile)
+
+def getPoseFileName(outFile, compression=None):
+    '''Returns the final name of a pose file from the one written by ledock -spli (<ligand>_dock001.pdb ->
+    <ligand>_1.pdb, <ligand>_1.pdb.gz if compressed with gzip)'''
+    outBase = os.path.basename(outFile)
+    newBase = '{}{}.pdb{}'.format(outBase.split('dock')[0], int(outBase.split('dock')[-1].split('.')[0]),
+                                  getCompressionExt(compression))
+    return os.path.join(os.path.dirname(outFile), newBase)
+
+def isSplitPoseFile(poseFile):
+    '''Whether a pose file keeps the name written by ledock -spli (<ligand>_dock001.pdb), not corrected yet'''
+    return os.path.basename(poseFile).rsplit('_', 1)[-1].startswith('dock')
+
+def parsePoseEnergy(poseFile):
+    '''Returns the energy (as written, a string) of a split pose file, from the score line following its header'''
+    with openFile(poseFile) as fPose:
+        fPose.readline()
+        line = fPose.readline()
+    return line.split()[-2]
+
+def listPoseFiles(pocketDir):
+    '''Returns a list of (ligandKey, poseFile) for the split poses in a pocket directory'''
+    poses = []
+    for entry in os.scandir(pocketDir):
+        if entry.is_dir():
+            for poseEntry in os.scandir(entry.path):
+                poses.append((entry.name.split('.')[0], poseEntry.path))
+    return poses
+
+def readPocketDockEnergies(pocketDir):
+    '''Returns a dictionary {ligandKey: best energy} from the .dok files of a pocket directory, including the ones
+    packed in results archives (read without extracting them)'''
+    energies = {}
+    for entry in os.scandir(pocketDir):
+        if isDockFile(entry.name):
+            dockEnergies = parseDockEnergies(entry.path)
+            if dockEnergies:
+                energies[entry.name.split('.')[0]] = min(dockEnergies)
+
+    for archive in getDockArchives(pocketDir):
+        with tarfile.open(archive) as tar:
+            for member in tar:
+                if isDockFile(member.name):
+                    with openFile(member.name, fileObj=tar.extractfile(member)) as f:
+                        dockEnergies = parseDockEnergyLines(f)
+                    if dockEnergies:
+                        energies[os.path.basename(member.name).split('.')[0]] = min(dockEnergies)
+    return energies
+
+########################### Ligand clustering ###########################
+
+def getMol2Fingerprint(molFile):
+    '''Returns a count fingerprint of a mol2 file made of its heavy atom types and typed bonds'''
+    atomTypes, fp, section = {}, Counter(), None
+    with open(molFile) as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                if section == 'BOND':
+                    break
+                section = line.strip()[9:]
+                continue
+
+            sline = line.split()
+            if section == 'ATOM' and len(sline) > 5:
+                aType = sline[5]
+                if aType.split('.')[0] != 'H':
+                    atomTypes[sline[0]] = aType
+                    fp[aType] += 1
+            elif section == 'BOND' and len(sline) > 3:
+                if sline[1] in atomTypes and sline[2] in atomTypes:
+                    tA, tB = sorted([atomTypes[sline[1]], atomTypes[sline[2]]])
+                    fp['{}{}{}'.format(tA, sline[3], tB)] += 1
+    return fp
+
+def getCountSimilarity(fpA, fpB):
+    '''Returns the Tanimoto similarity of two count fingerprints'''
+    inter = sum([min(c, fpB[k]) for k, c in fpA.items() if k in fpB])
+    union = sum(fpA.values()) + sum(fpB.values()) - inter
+    return inter / union if union > 0 else 1.0
+
+def leaderClustering(fps, cutoff):
+    '''Greedy leader clustering of count fingerprints. Each fingerprint is assigned to the most similar leader
+    with a similarity over the cutoff or becomes a new leader. Leaders are only compared when their fingerprint
+    sizes are compatible with the cutoff.
+    Returns a list of clusters, each one a list of fingerprint indexes with the leader in first position'''
+    clusters, leaderSizes, leaderIdxs = [], [], []
+    for i, fp in enumerate(fps):
+        size = sum(fp.values())
+        lo = bisect.bisect_left(leaderSizes, size * cutoff)
+        hi = bisect.bisect_right(leaderSizes, size / cutoff) if cutoff > 0 else len(leaderSizes)
+
+        bestSim, bestCluster = cutoff, None
+        for j in range(lo, hi):
+            sim = getCountSimilarity(fp, fps[clusters[leaderIdxs[j]][0]])
+            if sim >= bestSim:
+                bestSim, bestCluster = sim, leaderIdxs[j]
+
+        if bestCluster is None:
+            pos = bisect.bisect_right(leaderSizes, size)
+            leaderSizes.insert(pos, size)
+            leaderIdxs.insert(pos, len(clusters))
+            clusters.append([i])
+        else:
+            clusters[bestCluster].append(i)
+    return clusters
+
+def clusterMolFiles(molFiles, cutoff):
+    '''Clusters a list of mol2 files by their count fingerprints.
+    Returns a list of clusters, each one a list of files with the representative in first position'''
+    fps = [getMol2Fingerprint(molFile) for molFile in molFiles]
+    return [[molFiles[i] for i in cluster] for cluster in leaderClustering(fps, cutoff)]
+
+def groupByKey(items, keys):
+    '''Groups the items sharing the same key. Returns a list of groups in order of first appearance, each one a list
+    of items with the first appearing in first position'''
+    groups = {}
+    for item, key in zip(items, keys):
+        groups.setdefault(key, []).append(item)
+    return list(groups.values())
+
+def writeClustersFile(clustFile, clusters):
+    '''Writes a clusters file with a line per cluster containing its files, representative first'''
+    with open(clustFile, 'w') as f:
+        for members in clusters:
+            f.write('\t'.join(members) + '\n')
+    return clustFile
+
+def readClustersFile(clustFile):
+    with open(clustFile) as f:
+        return [line.strip().split('\t') for line in f if line.strip()]
+
+def selectBestEnergies(energies, topPerc=None, maxEnergy=None):
+    '''Returns the sorted indexes of the best elements given their energies (None if not available):
+    the topPerc % elements with lowest energies and those with an energy under maxEnergy'''
+    scored = sorted([(e, i) for i, e in enumerate(energies) if e is not None])
+    selected = set()
+    if topPerc:
+        nTop = int(math.ceil(len(scored) * topPerc / 100.0))
+        selected |= set([i for _, i in scored[:nTop]])
+    if maxEnergy is not None:
+        selected |= set([i for e, i in scored if e <= maxEnergy])
+    return sorted(selected)
+
+########################### Ligand descriptors ###########################
+
+def getFileHash(fileName, blockSize=1 << 20):
+    '''Returns the sha1 hex digest of the content of a file'''
+    sha = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def readDescriptorsFile(descFile):
+    '''Returns a dictionary {key: {descriptor: value}} from a descriptors file with a line per key and descriptor
+    (<key>\t<descriptor>\t<value>). Empty if the file does not exist'''
+    values = {}
+    if descFile and os.path.exists(descFile):
+        with open(descFile) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            lines = f.readlines()
+        for line in lines:
+            fields = line.strip().split('\t')
+            # Lines left incomplete by an interrupted run are ignored, so their descriptors are computed again
+            if not line.endswith('\n') or len(fields) != 3:
+                continue
+            try:
+                values.setdefault(fields[0], {})[fields[1]] = float(fields[2])
+            except ValueError:
+                continue
+    return values
+
+def appendDescriptorsFile(descFile, values):
+    '''Appends the {key: {descriptor: value}} values to a descriptors file. The file may be a cache shared by
+    concurrent runs, so all the lines are written at once holding an exclusive lock of the file'''
+    lines = ''.join(['{}\t{}\t{}\n'.format(key, descName, value)
+                     for key, keyValues in values.items() for descName, value in keyValues.items()])
+    with open(descFile, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(lines)
+        f.flush()
+    return descFile
+
+def parseFiltersList(filtersText):
+    '''Returns the (descriptor, minValue, maxValue) of the filters in a list built with the AddLePharFilter wizard,
+    whose lines look like: 1) Descriptor: MolLogP\t-1.0\t5.0'''
+    filters = []
+    for line in filtersText.strip().split('\n'):
+        if line.strip():
+            descName, minValue, maxValue = line.split(': ', 1)[1].split('\t')
+            filters.append((descName.strip(), float(minValue), float(maxValue)))
+    return filters
+
+############################## Ligand costs ##############################
+
+def getRingBonds(nAtoms, bonds):
+    '''Returns the set of bonds (sorted atom index pairs) which belong to a ring, i.e. are not bridges of the
+    molecular graph'''
+    adj = [[] for _ in range(nAtoms)]
+    for a, b in bonds:
+        adj[a].append(b)
+        adj[b].append(a)
+
+    disc, low, bridges, counter = [-1] * nAtoms, [0] * nAtoms, set(), 0
+    for root in range(nAtoms):
+        if disc[root] != -1:
+            continue
+        disc[root] = low[root] = counter
+        counter += 1
+        stack = [(root, -1, iter(adj[root]))]
+        while stack:
+            node, parent, neighbours = stack[-1]
+            child = next(neighbours, None)
+            if child is None:
+                stack.pop()
+                if parent != -1:
+                    low[parent] = min(low[parent], low[node])
+                    if low[node] > disc[parent]:
+                        bridges.add((min(node, parent), max(node, parent)))
+            elif disc[child] == -1:
+                disc[child] = low[child] = counter
+                counter += 1
+                stack.append((child, node, iter(adj[child])))
+            elif child != parent:
+                low[node] = min(low[node], disc[child])
+
+    return set([(min(a, b), max(a, b)) for a, b in bonds]) - bridges
+
+def getMol2CostDescriptors(molFile):
+    '''Returns the number of heavy atoms and rotatable bonds (non ring single bonds between non terminal heavy
+    atoms) of a mol2 file'''
+    heavyIdxs, bonds, section = {}, [], None
+    with open(molFile) as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                if section == 'BOND':
+                    break
+                section = line.strip()[9:]
+                continue
+
+            sline = line.split()
+            if section == 'ATOM' and len(sline) > 5 and sline[5].split('.')[0] != 'H':
+                heavyIdxs[sline[0]] = len(heavyIdxs)
+            elif section == 'BOND' and len(sline) > 3 and sline[1] in heavyIdxs and sline[2] in heavyIdxs:
+                bonds.append((heavyIdxs[sline[1]], heavyIdxs[sline[2]], sline[3]))
+
+    degrees = [0] * len(heavyIdxs)
+    for a, b, _ in bonds:
+        degrees[a] += 1
+        degrees[b] += 1
+    ringBonds = getRingBonds(len(heavyIdxs), [(a, b) for a, b, _ in bonds])
+    nRot = sum([1 for a, b, bType in bonds if bType == '1' and degrees[a] > 1 and degrees[b] > 1
+                and (min(a, b), max(a, b)) not in ringBonds])
+    return len(heavyIdxs), nRot
+
+def estimateLigandCost(descriptors, coefs=DEFAULT_COST_COEFS):
+    '''Estimates the docking cost of a ligand from its (heavy atoms, rotatable bonds) with a linear model'''
+    return coefs[0] + coefs[1] * descriptors[0] + coefs[2] * descriptors[1]
+
+def fitCostModel(descriptors, times, minSamples=10):
+    '''Least squares fit of the linear cost model coefficients from the (heavy atoms, rotatable bonds) and the
+    measured docking times of a set of ligands. Returns the default coefficients if it cannot be fitted'''
+    if len(times) < minSamples:
+        return DEFAULT_COST_COEFS
+    rows = [(1.0, float(h), float(r)) for h, r in descriptors]
+    # Normal equations solved by Gaussian elimination with partial pivoting
+    mat = [[sum([row[i] * row[j] for row in rows]) for j in range(3)] +
+           [sum([row[i] * t for row, t in zip(rows, times)])] for i in range(3)]
+    for col in range(3):
+        pivot = max(range(col, 3), key=lambda r: abs(mat[r][col]))
+        if abs(mat[pivot][col]) < 1e-12:
+            return DEFAULT_COST_COEFS
+        mat[col], mat[pivot] = mat[pivot], mat[col]
+        for r in range(3):
+            if r != col:
+                factor = mat[r][col] / mat[col][col]
+                mat[r] = [vr - factor * vc for vr, vc in zip(mat[r], mat[col])]
+    coefs = tuple([mat[i][3] / mat[i][i] for i in range(3)])
+    if any([c < 0 for c in coefs[1:]]):
+        return DEFAULT_COST_COEFS
+    return coefs
+
+def readLigandTimes(ligTimesFile):
+    '''Reads the mean docking time per ligand of a profile_ligands.csv file from a previous run'''
+    sums, counts = {}, {}
+    with open(ligTimesFile) as f:
+        for row in csv.DictReader(f):
+            sums[row['ligand']] = sums.get(row['ligand'], 0.0) + float(row['seconds'])
+            counts[row['ligand']] = counts.get(row['ligand'], 0) + 1
+    return {lig: sums[lig] / counts[lig] for lig in sums}
+
+def estimateInvocationOverhead(ligTimes, costs=None):
+    '''Returns the (startup overhead, seconds per unit of cost) of a ledock run from its ligand times (see
+    getLigandDockTimes) and the relative costs of those ligands (see getLigandCosts). Without costs, every ligand
+    costs 1 and the second value is the seconds per ligand. The first ligand time includes the receptor reading and
+    grid computation, so the time per unit of cost is the median over the rest of ligands (with 3 calibration
+    ligands, the lowest of the 2 after the first) and the overhead what the first one took beyond its cost'''
+    times = [t for _, t in ligTimes]
+    if len(times) < 2:
+        return None, None
+    costs = costs or [1.0] * len(times)
+    rates = sorted([t / max(cost, 1e-9) for t, cost in zip(times[1:], costs[1:])])
+    rate = rates[(len(rates) - 1) // 2]
+    return max(times[0] - rate * costs[0], 0.0), rate
+
+def getSpreadSample(items, n):
+    '''Returns n items evenly spread along items and the rest of them, both in their original order'''
+    if len(items) <= n:
+        return list(items), []
+    idxs = set([i * len(items) // n for i in range(n)])
+    return [item for i, item in enumerate(items) if i in idxs], [item for i, item in enumerate(items) if i not in idxs]
+
+def getOptimalChunkSize(nLigands, overhead, perLigand):
+    '''Returns the chunk size minimizing the time of docking nLigands in chunks, estimated as the startup overhead
+    paid by every chunk (nLigands / size * overhead) plus the load imbalance of up to a chunk at the end of the
+    jobs (size * perLigand)'''
+    if not perLigand or overhead is None:
+        return max(nLigands, 1)
+    return int(min(max(round(math.sqrt(nLigands * overhead / perLigand)), 1), max(nLigands, 1)))
+
+def planDockJobs(nLigands, nJobs, nRuns, overhead, perLigand, autoChunk=False):
+    '''Returns the plan of docking nLigands in a pocket with nJobs jobs: ledock invocations, output files (upper
+    bound, nRuns poses per ligand and its split directory) and estimated CPU and wall seconds, from the ledock
+    startup overhead and the seconds per ligand'''
+    nActive, perJob = min(nJobs, nLigands), int(math.ceil(nLigands / nJobs))
+    invocations = nActive
+    if autoChunk and perJob > CALIBRATION_LIGANDS:
+        chunkSize = getOptimalChunkSize(perJob - CALIBRATION_LIGANDS, overhead, perLigand)
+        invocations = nActive * (1 + int(math.ceil((perJob - CALIBRATION_LIGANDS) / chunkSize)))
+    cpuSeconds = invocations * overhead + nLigands * perLigand
+    return {'ligands': nLigands, 'jobs': nJobs, 'invocations': invocations, 'files': nLigands * (nRuns + 1),
+            'cpuSeconds': cpuSeconds, 'wallSeconds': cpuSeconds / nActive if nActive else 0.0}
+
+def summarizeDockPlan(targets, nLigands, nThreads, packLibrary=False):
+    '''Adds up the stage plans of every target ({name: {'stages': [plan]}}) into the plan of the screen. The wall
+    time assumes the jobs of all the targets share nThreads'''
+    plan = {'nLigands': nLigands, 'threads': nThreads, 'targets': targets, 'jobs': 0, 'invocations': 0,
+            'cpuSeconds': 0.0}
+    # Converted ligands, plus their links in each pocket if they are not packed in a library
+    plan['files'] = 2 if packLibrary else nLigands
+    for target in targets.values():
+        target['cpuSeconds'] = sum([stage['cpuSeconds'] for stage in target['stages']])
+        plan['cpuSeconds'] += target['cpuSeconds']
+        for stage in target['stages']:
+            plan['jobs'] += stage['jobs']
+            plan['invocations'] += stage['invocations']
+            plan['files'] += stage['files']
+        if not packLibrary:
+            plan['files'] += nLigands
+    plan['wallSeconds'] = plan['cpuSeconds'] / max(nThreads, 1)
+    return plan
+
+def getLigandCosts(molFiles, prevTimes=None):
+    '''Returns the estimated docking cost of each mol2 file. If the times of a previous run are provided, the cost
+    model is fitted to them and the measured time is used for the ligands already docked'''
+    descriptors = [getMol2CostDescriptors(molFile) for molFile in molFiles]
+    keys = [getLigandKey(molFile) for molFile in molFiles]
+    coefs = DEFAULT_COST_COEFS
+    if prevTimes:
+        known = [(desc, prevTimes[key]) for desc, key in zip(descriptors, keys) if key in prevTimes]
+        coefs = fitCostModel([k[0] for k in known], [k[1] for k in known])
+    return [prevTimes[key] if prevTimes and key in prevTimes else estimateLigandCost(desc, coefs)
+            for desc, key in zip(descriptors, keys)]
+
+def packLongestFirst(items, costs, nBins):
+    '''Longest processing time first packing: items are assigned in decreasing cost order to the bin with the
+    lowest load. Returns nBins lists of items, each of them in decreasing cost order'''
+    bins = [[] for _ in range(nBins)]
+    loads = [(0.0, i) for i in range(nBins)]
+    for cost, idx in sorted([(c, i) for i, c in enumerate(costs)], key=lambda ci: (-ci[0], ci[1])):
+        load, iBin = heapq.heappop(loads)
+        bins[iBin].append(items[idx])
+        heapq.heappush(loads, (load + cost, iBin))
+    return bins
+
+def writeCostsFile(costsFile, molFiles, costs):
+    with open(costsFile, 'w') as f:
+        for molFile, cost in zip(molFiles, costs):
+            f.write('{}\t{}\n'.format(molFile, cost))
+    return costsFile
+
+def readCostsFile(costsFile):
+    with open(costsFile) as f:
+        return {line.split('\t')[0]: float(line.split('\t')[1]) for line in f if line.strip()}
+
+############################## Profiling ##############################
+
+@contextmanager
+def timeStage(profileDir, stage, key='main'):
+    '''Context manager recording the wall time of a stage execution into a json file in profileDir.
+    Each execution writes its own file, so it can be used from parallel steps. Yields the record, which can be
+    completed with more information'''
+    record = {'stage': stage, 'key': key, 'start': time.time()}
+    try:
+        yield record
+    finally:
+        record['end'] = time.time()
+        record['wall'] = record['end'] - record['start']
+        os.makedirs(profileDir, exist_ok=True)
+        with open(os.path.join(profileDir, 'stage_{}_{}.json'.format(stage, key)), 'w') as f:
+            json.dump(record, f)
+
+def getLigandDockTimes(dokFiles, start):
+    '''Returns the (dokFile, seconds) of the ligands docked by a ledock run which started at start, from the
+    modification times of their .dok files. dokFiles must follow the ledock ligands list order, since ledock
+    docks them sequentially'''
+    times, prev = [], start
+    for dokFile in dokFiles:
+        if isDockDone(dokFile, start):
+            mTime = os.path.getmtime(dokFile)
+            times.append((dokFile, max(mTime - prev, 0.0)))
+            prev = max(mTime, prev)
+    return times
+
+def writeLigandTimes(profileDir, key, pocketName, ligTimes):
+    '''Writes the docking times of the ligands of a ledock run'''
+    os.makedirs(profileDir, exist_ok=True)
+    with open(os.path.join(profileDir, 'ligands_{}.tsv'.format(key)), 'w') as f:
+        for dokFile, seconds in ligTimes:
+            f.write('{}\t{}\t{}\t{:.3f}\n'.format(getLigandKey(dokFile), pocketName, key, seconds))
+
+def summarizeProfile(profileDir, outDir, nSlowest=10):
+    '''Gathers the stage and ligand records of profileDir into profile.json, profile_stages.csv and
+    profile_ligands.csv in outDir. Returns the profile summary dictionary'''
+    stages, records = {}, []
+    for recFile in glob.glob(os.path.join(profileDir, 'stage_*.json')):
+        with open(recFile) as f:
+            records.append(json.load(f))
+    for rec in sorted(records, key=lambda r: r['start']):
+        st = stages.setdefault(rec['stage'], {'jobs': 0, 'total': 0.0, 'max': 0.0,
+                                              'start': rec['start'], 'end': rec['end']})
+        st['jobs'] += 1
+        st['total'] += rec['wall']
+        st['max'] = max(st['max'], rec['wall'])
+        st['end'] = max(st['end'], rec['end'])
+
+    ligRecords = []
+    for ligFile in glob.glob(os.path.join(profileDir, 'ligands_*.tsv')):
+        with open(ligFile) as f:
+            for line in f:
+                lig, pocketName, key, seconds = line.strip().split('\t')
+                ligRecords.append((lig, pocketName, key, float(seconds)))
+    ligRecords.sort(key=lambda r: r[3], reverse=True)
+
+    with open(os.path.join(outDir, 'profile_stages.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stage', 'key', 'start', 'end', 'wall'])
+        for rec in sorted(records, key=lambda r: r['start']):
+            writer.writerow([rec['stage'], rec['key'], rec['start'], rec['end'], '{:.3f}'.format(rec['wall'])])
+
+    with open(os.path.join(outDir, 'profile_ligands.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ligand', 'pocket', 'job', 'seconds'])
+        writer.writerows(ligRecords)
+
+    ligTimes = [r[3] for r in ligRecords]
+    profile = {'stages': stages, 'nLigandDocks': len(ligRecords),
+               'meanLigandTime': sum(ligTimes) / len(ligTimes) if ligTimes else None,
+               'slowestLigands': ligRecords[:nSlowest]}
+    with open(os.path.join(outDir, 'profile.json'), 'w') as f:
+        json.dump(profile, f, indent=2)
+    return profile
+
+def countProfileLigands(profileDir):
+    '''Returns the number of ligands docked in each pocket according to the ligand records of profileDir'''
+    counts = Counter()
+    for ligFile in glob.glob(os.path.join(profileDir, 'ligands_*.tsv')):
+        with open(ligFile) as f:
+            for line in f:
+                counts[line.split('\t')[1]] += 1
+    return dict(counts)
+
+############################### Progress ###############################
+
+def countDockedPrefix(dokFiles, start):
+    '''Returns the number of ligands already docked by a running ledock execution started at start. ledock docks
+    them sequentially, so the finished ones are a prefix of dokFiles, found checking only log2(n) files'''
+    lo, hi = 0, len(dokFiles)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if isDockDone(dokFiles[mid], start):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def formatDuration(seconds):
+    '''Returns a short human readable duration'''
+    if seconds is None:
+        return 'unknown'
+    elif seconds < 3600:
+        return '{:.0f} min'.format(seconds / 60)
+    elif seconds < 3 * 86400:
+        return '{:.1f} h'.format(seconds / 3600)
+    return '{:.1f} days'.format(seconds / 86400)
+
+def countListsLigands(listFiles, cache):
+    '''Returns the number of ligands in the existing list files of each key of listFiles ({key: [listFile]}).
+    Ligand lists do not change once published, so the counts are kept in cache and each one is only read once'''
+    counts = {}
+    for key, files in listFiles.items():
+        for listFile in files:
+            if listFile not in cache and os.path.exists(listFile):
+                cache[listFile] = len(readListFile(listFile))
+            counts[key] = counts.get(key, 0) + cache.get(listFile, 0)
+    return counts
+
+class DockProgress:
+    '''Tracks the ligands docked in each pocket while the docking jobs run, and periodically reports the ligands
+    done, the docking rate and the estimated time left in the log and in a json file.
+    Finished chunks are counted when they end and the running ones with countDockedPrefix, so a report only checks a
+    few files per running chunk. totalsFunc returns the number of ligands to dock in each pocket'''
+    def __init__(self, progressFile, totalsFunc, doneCounts=None, period=PROGRESS_PERIOD):
+        self.progressFile, self.totalsFunc, self.period = progressFile, totalsFunc, period
+        self.lock, self.stopEvent, self.thread = threading.Lock(), threading.Event(), None
+        # Ligands docked before this monitor started (e.g: in a previous execution), which do not count for the rates
+        self.done = Counter(doneCounts or {})
+        self.newDone, self.firstStart, self.running = Counter(), {}, {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops the periodic reports and writes the last one'''
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+            self.report()
+
+    def _run(self):
+        while not self.stopEvent.wait(self.period):
+            self.report()
+
+    def startChunk(self, chunkKey, pocketName, dokFiles, start):
+        with self.lock:
+            self.running[chunkKey] = (pocketName, dokFiles, start)
+            self.firstStart.setdefault(pocketName, start)
+
+    def endChunk(self, chunkKey):
+        with self.lock:
+            pocketName, dokFiles, start = self.running.pop(chunkKey)
+        nDone = countDockedPrefix(dokFiles, start)
+        with self.lock:
+            self.done[pocketName] += nDone
+            self.newDone[pocketName] += nDone
+
+    def getProgress(self):
+        '''Returns {pocketName: {done, total, rate (ligands/h), eta (s)}}'''
+        now, totals = time.time(), self.totalsFunc()
+        with self.lock:
+            done, newDone, firstStart = Counter(self.done), Counter(self.newDone), dict(self.firstStart)
+            running = list(self.running.values())
+        for pocketName, dokFiles, start in running:
+            nDone = countDockedPrefix(dokFiles, start)
+            done[pocketName] += nDone
+            newDone[pocketName] += nDone
+
+        progress = {}
+        for pocketName, total in totals.items():
+            elapsed = now - firstStart.get(pocketName, now)
+            rate = newDone[pocketName] * 3600 / elapsed if elapsed > 0 else 0.0
+            nDone = min(done[pocketName], total)
+            progress[pocketName] = {'done': nDone, 'total': total, 'rate': rate,
+                                    'eta': (total - nDone) * 3600 / rate if rate else None}
+        return progress
+
+    def report(self):
+        progress = self.getProgress()
+        for pocketName, info in sorted(progress.items()):
+            print('Progress of {}: {} of {} ligands docked, {:.1f} ligands/h, time left {}'.format(
+                pocketName, info['done'], info['total'], info['rate'], formatDuration(info['eta'])), flush=True)
+        with open(self.progressFile + '.tmp', 'w') as f:
+            json.dump({'time': time.time(), 'pockets': progress}, f, indent=2)
+        os.replace(self.progressFile + '.tmp', self.progressFile)
+        return progress
+
+############################## CPU affinity ##############################
+
+NUMA_NODES_DIR = '/sys/devices/system/node'
+
+def isAffinityAvailable():
+    '''Whether processes can be pinned to CPUs (Linux only)'''
+    return hasattr(os, 'sched_setaffinity')
+
+def parseCpuList(cpuList):
+    '''Returns the CPU ids of a kernel cpulist string (e.g: 0-3,8-11)'''
+    cpus = []
+    for part in cpuList.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += list(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def getNumaNodesCpus():
+    '''Returns the lists of CPUs available to this process in each NUMA node. Without NUMA information, all of
+    them are considered a single node'''
+    available = os.sched_getaffinity(0)
+    nodes = []
+    for nodeFile in glob.glob(os.path.join(NUMA_NODES_DIR, 'node*', 'cpulist')):
+        with open(nodeFile) as f:
+            nodeCpus = [cpu for cpu in parseCpuList(f.read()) if cpu in available]
+        if nodeCpus:
+            nodes.append(nodeCpus)
+    return sorted(nodes) if nodes else [sorted(available)]
+
+def getWorkerCpuSets(nWorkers, nodesCpus=None):
+    '''Returns a dedicated set of CPUs for each of nWorkers concurrent workers. The workers are spread among the
+    NUMA nodes in turns and each one gets an equal part of the CPUs of its node (shared if there are more workers
+    than CPUs in the node)'''
+    nodesCpus = nodesCpus or getNumaNodesCpus()
+    nodeWorkers = [[] for _ in nodesCpus]
+    for iWorker in range(nWorkers):
+        nodeWorkers[iWorker % len(nodesCpus)].append(iWorker)
+
+    cpuSets = [None] * nWorkers
+    for nodeCpus, workers in zip(nodesCpus, nodeWorkers):
+        for iSlot, iWorker in enumerate(workers):
+            if len(workers) <= len(nodeCpus):
+                size = len(nodeCpus) // len(workers)
+                cpuSets[iWorker] = set(nodeCpus[iSlot * size:(iSlot + 1) * size])
+            else:
+                cpuSets[iWorker] = {nodeCpus[iSlot % len(nodeCpus)]}
+    return cpuSets
+
+def setProcessAffinity(pid, cpus):
+    '''Pins a running process to a set of CPUs. Does nothing if cpus is None or the process already finished'''
+    if cpus is None or not isAffinityAvailable():
+        return
+    try:
+        os.sched_setaffinity(pid, cpus)
+    except (ProcessLookupError, OSError):
+        pass
+
+@contextmanager
+def pinThreadAffinity(cpus):
+    '''Pins the calling thread to a set of CPUs while in the context, so that the processes it starts inherit it'''
+    if cpus is None or not isAffinityAvailable():
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+class CpuSlots:
+    '''Pool of the dedicated CPU sets of nWorkers concurrent workers (see getWorkerCpuSets). A worker takes a free
+    set for the duration of its slot context, which gives None if there is no free set (or nWorkers is 0)'''
+    def __init__(self, nWorkers):
+        self.free = queue.Queue()
+        for cpus in getWorkerCpuSets(nWorkers) if nWorkers else []:
+            self.free.put(cpus)
+
+    @contextmanager
+    def slot(self):
+        try:
+            cpus = self.free.get_nowait()
+        except queue.Empty:
+            cpus = None
+        try:
+            yield cpus
+        finally:
+            if cpus is not None:
+                self.free.put(cpus)
@@ -22,10 +22,83 @@
 # *
 # **************************************************************************
 
+import os
+
 import pyworkflow.viewer as pwviewer
+import pyworkflow.protocol.params as params
+
+from pwchem.viewers import SmallMoleculesViewer, PyMolViewer
+from lephar.protocols import ProtChemLeDock
+
+
+#SmallMoleculesViewer._targets.append(ProtChemClusterMCS)
+
+class LeDockViewer(pwviewer.ProtocolViewer):
+  """ Viewer of the LeDock results by pages of poses ranked by energy, read from the score table of the protocol
+  so only the poses of the shown page are loaded """
+  _label = 'LeDock results viewer'
+  _targets = [ProtChemLeDock]
+  _environments = [pwviewer.DESKTOP_TKINTER]
+
+  def _defineParams(self, form):
+    form.addSection(label='Results')
+    group = form.addGroup('Ranking')
+    group.addParam('topN', params.IntParam, default=5, label='Top poses per pocket: ',
+                   help='Number of best poses of each pocket shown in the summary')
+    group.addParam('displayTop', params.LabelParam, label='Show pockets summary: ',
+                   help='Show the best poses of each pocket')
+
+    group = form.addGroup('Poses')
+    group.addParam('pocketChoice', params.EnumParam, choices=self._getPocketChoices(), default=0,
+                   label='Pocket: ', help='Pocket whose poses are shown, or all of them')
+    group.addParam('pageSize', params.IntParam, default=20, label='Poses per page: ')
+    group.addParam('page', params.IntParam, default=1, label='Page: ',
+                   help='Page of poses to show, from the best scored ones')
+    group.addParam('displayPage', params.LabelParam, label='View page poses with PyMol: ',
+                   help='Open the receptor and the poses of the page')
+
+  def _getVisualizeDict(self):
+    return {'displayTop': self._showTopSummary,
+            'displayPage': self._showPage}
+
+  def _getScoreTable(self):
+    if not hasattr(self, '_scoreTable'):
+      self._scoreTable = self.protocol.getScoreTable()
+    return self._scoreTable
+
+  def _getPocketChoices(self):
+    if not os.path.exists(self.protocol.getScoreTableFile()):
+      return ['All']
+    return ['All'] + self._getScoreTable().pockets
+
+  def _getPocket(self):
+    return None if self.pocketChoice.get() == 0 else self._getScoreTable().pockets[self.pocketChoice.get() - 1]
+
+  def _showTopSummary(self, e=None):
+    table, lines = self._getScoreTable(), []
+    for pocket in table.pockets:
+      lines.append('{}:'.format(pocket))
+      lines += ['  {} pose {}: {:.2f}'.format(lig, poseId, energy)
+                for lig, _, poseId, energy in table.topN(self.topN.get(), pocket)]
+    self.showInfo('\n'.join(lines), 'LeDock best poses per pocket')
 
-from pwchem.viewers import SmallMoleculesViewer
-from lephar.protocols import *
+  def _showPage(self, e=None):
+    table, pageSize = self._getScoreTable(), self.pageSize.get()
+    ranked = table.topN(self.page.get() * pageSize, self._getPocket())
+    pageRecords = ranked[(self.page.get() - 1) * pageSize:]
+    if not pageRecords:
+      self.showError('Page {} is empty: there are {} poses'.format(self.page.get(), len(ranked)))
+      return
 
+    pmlFile = os.path.abspath(self.protocol._getExtraPath('viewPage_{}.pml'.format(self.page.get())))
+    with open(pmlFile, 'w') as f:
+      recIds = set([self.protocol.getPocketDirReceptorId(pocket) for _, pocket, _, _ in pageRecords])
+      for recId in recIds:
+        f.write('load {}\n'.format(os.path.abspath(self.protocol.getOriginalReceptorFile(recId))))
+      for lig, pocket, poseId, energy in pageRecords:
+        poseFile = self.protocol.getPoseFile(table, lig, pocket, poseId)
+        if poseFile:
+          f.write('load {}, {}_{}_{}\n'.format(poseFile, lig, pocket, poseId))
+      f.write('hide everything\nshow cartoon\nshow sticks, organic\nzoom organic\n')
 
-#SmallMoleculesViewer._targets.append(ProtChemClusterMCS)
\ No newline at end of file
+    return PyMolViewer(project=self.getProject())._visualize(pmlFile, cwd=os.path.dirname(pmlFile))
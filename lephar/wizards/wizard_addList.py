@@ -33,7 +33,7 @@ information such as name and number of residues.
 """
 
 # Imports
-from ..protocols import *
+from ..protocols import ProtChemLePharFilter
 import pyworkflow.wizard as pwizard
 from pwem.wizards import VariableWizard
 
@@ -63,3 +63,7 @@ class AddLePharFilter(VariableWizard):
                                          getattr(protocol, inputParams[2]).get())
           form.setVar(outputParam[0], inList + '{}) {}: {}\n'.format(num, label, descInfo))
 
+AddLePharFilter().addTarget(protocol=ProtChemLePharFilter,
+                            targets=['filtersList'],
+                            inputs=['descriptor', 'minValue', 'maxValue'],
+                            outputs=['filtersList'])
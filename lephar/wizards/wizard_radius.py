@@ -33,7 +33,7 @@ to select the radius of the sphere that contains the protein or a desired zone.
 
 # Imports
 from pwchem.wizards import GetRadiusProtein, SelectMultiChainWizard
-from ..protocols import *
+from ..protocols import ProtChemLeDock, ProtChemLePro
 
 GetRadiusProtein().addTarget(protocol=ProtChemLeDock,
                              targets=['radius'],